@@ -0,0 +1,85 @@
+import json
+import os
+import time
+
+from checkpoint import dd_command, marker
+from locking import file_lock
+from station import station_dir
+
+TUNE_MARKER = 'TUNE_DONE'
+UPTIME = "$(cut -d' ' -f1 /proc/uptime)"
+
+
+def trial_command(length, block_bytes, depth, source='/dev/sdc', target='/dev/sdb'):
+    return (
+        f't0={UPTIME}; {dd_command(0, length, block_bytes, depth, "fsync", source, target)}; '
+        f'echo {marker(TUNE_MARKER)} $s $t0 {UPTIME}'
+    )
+
+
+class Calibration:
+    def __init__(self, block_sizes, depths, trial_bytes):
+        self.depths = depths
+        self.trial_bytes = trial_bytes
+        self.pending = [(block, depths[0]) for block in block_sizes]
+        self.results = []
+        self.current = None
+        self.depth_phase = False
+
+    def next(self):
+        if not self.pending and not self.depth_phase:
+            self.depth_phase = True
+            best = self.best()
+            if best:
+                self.pending = [(best['block_bytes'], depth) for depth in self.depths[1:]]
+        self.current = self.pending.pop(0) if self.pending else None
+        return self.current
+
+    def record(self, seconds):
+        block, depth = self.current
+        self.results.append((block, depth, self.trial_bytes / 1024 / 1024 / max(seconds, 0.01)))
+
+    def best(self):
+        if not self.results:
+            return None
+        block, depth, rate = max(self.results, key=lambda result: result[2])
+        return {'block_bytes': block, 'depth': depth, 'mb_per_second': round(rate, 1)}
+
+
+class TuneCache:
+    def __init__(self, path):
+        self.path = path if os.path.isabs(path) else os.path.join(station_dir(), path)
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, model, serial):
+        try:
+            with file_lock(f'{self.path}.lock'):
+                entries = self.load()
+        except OSError:
+            return None
+        if serial and f'serial:{serial}' in entries:
+            return entries[f'serial:{serial}']
+        return entries.get(f'model:{model}') if model else None
+
+    def put(self, model, serial, result):
+        # a lost cache entry only costs the next disk a calibration, so failures are ignored
+        try:
+            with file_lock(f'{self.path}.lock'):
+                entries = self.load()
+                result = dict(result, updated=time.time())
+                if serial:
+                    entries[f'serial:{serial}'] = result
+                if model:
+                    entries[f'model:{model}'] = result
+                tmp_path = f'{self.path}.tmp'
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f, indent=2)
+                os.replace(tmp_path, self.path)
+        except OSError:
+            pass
@@ -0,0 +1,342 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import struct
+import subprocess
+import tempfile
+import time
+
+from blockio import IO_PROFILES, image_opts
+from checkpoint import segment_command, split_segments
+from fanout import FanoutWriter
+from imageinfo import RawImage, analyze, free_ranges, open_image, read_partitions, subtract_ranges
+
+MB = 1024 * 1024
+STRATEGIES = ('full', 'used', 'fanout', 'qcow2')
+PATTERNS = ('random', 'text', 'zeros')
+PARTITION_OFFSET = MB
+
+
+def make_image(path, size, zero_ratio=0.5, chunk_size=4 * 1024 * 1024):
+    data_chunk = os.urandom(chunk_size)
+    zero_chunk = bytes(chunk_size)
+    written = 0
+    index = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            length = min(chunk_size, size - written)
+            zero = (index * zero_ratio) % 1 + zero_ratio >= 1
+            f.write((zero_chunk if zero else data_chunk)[:length])
+            written += length
+            index += 1
+
+
+def attach_loop(backing_file):
+    return subprocess.check_output(['losetup', '--find', '--show', backing_file], text=True).strip()
+
+
+def detach_loop(device):
+    subprocess.run(['losetup', '--detach', device], check=False)
+
+
+def drop_cache(*paths):
+    # every profile starts cold, otherwise later ones read the source from the page cache
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def convert(qemu_img, source, target, profile):
+    command = [
+        qemu_img, 'convert', '-n', '-p',
+        '--image-opts', image_opts(source, 'source', profile),
+        '--target-image-opts', image_opts(target, 'target', profile, driver='host_device'),
+    ]
+    start = time.monotonic()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    with open(target, 'rb+') as f:
+        os.fsync(f.fileno())
+    return time.monotonic() - start
+
+
+def fill_file(path, size, pattern, chunk_size=4 * MB):
+    if pattern == 'random':
+        chunk = os.urandom(chunk_size)
+    elif pattern == 'text':
+        chunk = (b'netflex firmware benchmark ' * (chunk_size // 27 + 1))[:chunk_size]
+    else:
+        chunk = bytes(chunk_size)
+    with open(path, 'wb') as f:
+        for offset in range(0, size, chunk_size):
+            f.write(chunk[:min(chunk_size, size - offset)])
+
+
+def make_firmware(path, size, fill_ratio, pattern, workdir):
+    partition_size = size - PARTITION_OFFSET
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        mbr = bytearray(512)
+        struct.pack_into('<B3xB3xII', mbr, 446, 0x80, 0x83, PARTITION_OFFSET // 512, partition_size // 512)
+        mbr[510:512] = b'\x55\xaa'
+        f.write(mbr)
+    subprocess.run(
+        ['mke2fs', '-q', '-F', '-t', 'ext4', '-E', f'offset={PARTITION_OFFSET}', path, f'{partition_size // 1024}k'],
+        check=True
+    )
+    data = os.path.join(workdir, 'payload.bin')
+    fill_file(data, int(partition_size * fill_ratio), pattern)
+    debugfs(path, PARTITION_OFFSET, ['mkdir /etc', f'write {data} /payload.bin'])
+    os.remove(data)
+
+
+def debugfs(path, offset, requests):
+    script = '\n'.join(requests) + '\n'
+    subprocess.run(
+        ['debugfs', '-w', '-f', '-', f'{path}?offset={offset}'], input=script, text=True, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+
+def reset_target(backing, size, chunk_size=4 * MB):
+    # stale data a strategy fails to overwrite must show up in verify and e2fsck
+    pattern = b'\xa5stale target data\x5a'
+    garbage = (pattern * (chunk_size // len(pattern) + 1))[:chunk_size]
+    with open(backing, 'wb') as f:
+        for offset in range(0, size, chunk_size):
+            f.write(garbage[:min(chunk_size, size - offset)])
+
+
+def required_ranges(image):
+    with open_image(image) as source:
+        return subtract_ranges(source.size, free_ranges(source, read_partitions(source)))
+
+
+def copy_segments(image, device, ranges, block_bytes, depth):
+    for offset, length in split_segments(ranges, 1024 * MB):
+        command = segment_command(offset, length, block_bytes, depth=depth, source=image, target=device)
+        output = subprocess.run(['sh', '-c', command], capture_output=True, text=True).stdout
+        if not output.strip().endswith(' 0'):
+            raise RuntimeError(f'dd failed at {offset}: {output.strip()}')
+
+
+def verify(image, device, ranges, chunk_size=4 * MB):
+    with open_image(image) as source, RawImage(device) as target:
+        for offset, length in ranges:
+            for start in range(offset, offset + length, chunk_size):
+                step = min(chunk_size, offset + length - start)
+                if hashlib.md5(source.pread(start, step)).digest() != hashlib.md5(target.pread(start, step)).digest():
+                    return False
+    return True
+
+
+def extend_and_personalize(device, target_size, settings):
+    with open(device, 'r+b') as f:
+        f.seek(446 + 12)
+        f.write(struct.pack('<I', (target_size - PARTITION_OFFSET) // 512))
+        os.fsync(f.fileno())
+    partition = subprocess.check_output(
+        ['losetup', '--find', '--show', '--offset', str(PARTITION_OFFSET), device], text=True
+    ).strip()
+    try:
+        subprocess.run(['e2fsck', '-f', '-p', partition], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        subprocess.run(['resize2fs', partition], check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        debugfs(partition, 0, ['rm /etc/system.yaml', f'write {settings} /etc/system.yaml'])
+        check = subprocess.run(['e2fsck', '-f', '-n', partition], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return check.returncode == 0
+    finally:
+        detach_loop(partition)
+
+
+def usage():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+    return cpu, max(self_usage.ru_maxrss, children.ru_maxrss) / 1024
+
+
+def run_strategy(strategy, image, devices, ranges, required, block_bytes, depth, target_size, settings):
+    cpu_start, _ = usage()
+    start = time.monotonic()
+    if strategy in ('full', 'used'):
+        copy_segments(image, devices[0], ranges, block_bytes, depth)
+    else:
+        results = FanoutWriter(image, devices, ranges, chunk_size=block_bytes).run()
+        failed = [r for r in results if r['error']]
+        if failed:
+            raise RuntimeError(failed[0]['error'])
+    write_seconds = time.monotonic() - start
+    verified = all(verify(image, device, required) for device in devices)
+    verify_seconds = time.monotonic() - start - write_seconds
+    personalized = all(extend_and_personalize(device, target_size, settings) for device in devices)
+    wall = time.monotonic() - start
+    cpu_end, peak_rss = usage()
+    written = sum(length for _, length in ranges) * len(devices)
+    return {
+        'strategy': strategy,
+        'targets': len(devices),
+        'bytes': written,
+        'write_s': round(write_seconds, 3),
+        'mb_s': round(written / write_seconds / MB, 1),
+        'verify_s': round(verify_seconds, 3),
+        'verified': verified,
+        'personalize_s': round(wall - write_seconds - verify_seconds, 3),
+        'personalized': personalized,
+        'wall_s': round(wall, 3),
+        'cpu_s': round(cpu_end - cpu_start, 3),
+        'peak_rss_mb': round(peak_rss, 1),
+    }
+
+
+def bench_suite(strategies, size, fill_ratio, pattern, workdir, qemu_img, block_bytes, depth, fanout_targets):
+    image = os.path.join(workdir, 'firmware.img')
+    make_firmware(image, size, fill_ratio, pattern, workdir)
+    with open_image(image) as source:
+        used_ranges = analyze(source, block_bytes)['ranges']
+    required = required_ranges(image)
+    target_size = size * 2
+    settings = os.path.join(workdir, 'system.yaml')
+    with open(settings, 'w', encoding='utf-8') as f:
+        f.write('uuid: benchmark\nmanagement_id: bench\ndevice_id: bench\n')
+    results = []
+    for strategy in strategies:
+        source = image
+        ranges = [(0, size)] if strategy == 'full' else used_ranges
+        if strategy == 'qcow2':
+            if not qemu_img:
+                print(f'{strategy:<8} skipped, qemu-img not found')
+                continue
+            source = os.path.join(workdir, 'firmware.qcow2')
+            subprocess.run([qemu_img, 'convert', '-O', 'qcow2', image, source], check=True)
+            with open_image(source) as qcow2:
+                ranges = analyze(qcow2, block_bytes)['ranges']
+        backings = [os.path.join(workdir, f'target{i}.img') for i in range(fanout_targets if strategy == 'fanout' else 1)]
+        devices = []
+        try:
+            for backing in backings:
+                reset_target(backing, target_size)
+                devices.append(attach_loop(backing))
+            # a fresh forkserver child per strategy, so ru_maxrss holds only this strategy's peak;
+            # forked or spawned children start with the parent's high-water mark
+            with multiprocessing.get_context('forkserver').Pool(1) as pool:
+                results.append(pool.apply(run_strategy, (
+                    strategy, source, devices, ranges, required, block_bytes, depth, target_size, settings
+                )))
+        finally:
+            for device in devices:
+                detach_loop(device)
+            for backing in backings:
+                os.remove(backing)
+        result = results[-1]
+        print(
+            f"{strategy:<8} {result['mb_s']:>8} MB/s  write {result['write_s']:.2f}s  wall {result['wall_s']:.2f}s  "
+            f"cpu {result['cpu_s']:.2f}s  verified {result['verified']}  personalized {result['personalized']}"
+        )
+    return results
+
+
+def compare(results, baseline, tolerance):
+    previous = {result['strategy']: result for result in baseline.get('results', [])}
+    regressions = []
+    for result in results:
+        old = previous.get(result['strategy'])
+        if old and result['mb_s'] < old['mb_s'] * (1 - tolerance):
+            regressions.append(f"{result['strategy']}: {result['mb_s']} MB/s, baseline {old['mb_s']} MB/s")
+        if old and old['verified'] and not result['verified']:
+            regressions.append(f"{result['strategy']}: verification failed")
+    return regressions
+
+
+def bench_profiles(profiles, size, zero_ratio, workdir, qemu_img):
+    source = os.path.join(workdir, 'source.img')
+    backing = os.path.join(workdir, 'target.img')
+    make_image(source, size, zero_ratio)
+    results = []
+    for profile in profiles:
+        # a fresh sparse target per profile, so none of them overwrites blocks an earlier one allocated
+        with open(backing, 'wb') as f:
+            f.truncate(size)
+        device = attach_loop(backing)
+        try:
+            drop_cache(source, backing, device)
+            elapsed = convert(qemu_img, source, device, profile)
+        finally:
+            detach_loop(device)
+            os.remove(backing)
+        results.append({
+            'profile': profile,
+            'bytes': size,
+            'seconds': round(elapsed, 3),
+            'mb_s': round(size / elapsed / 1024 / 1024, 1),
+        })
+        print(f'{profile:<16} {results[-1]["mb_s"]:>8} MB/s  {elapsed:.2f}s')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark block I/O profiles against a loop device.')
+    parser.add_argument('--profiles', nargs='*', default=list(IO_PROFILES))
+    parser.add_argument('--size-mb', type=int, default=1024)
+    parser.add_argument('--zero-ratio', type=float, default=0.5)
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--qemu-img', default=shutil.which('qemu-img'))
+    parser.add_argument('--output', default=None)
+    suite = parser.add_argument_group('end-to-end suite')
+    suite.add_argument('--suite', action='store_true', help='Write, verify and personalize with each strategy')
+    suite.add_argument('--strategies', nargs='*', choices=STRATEGIES, default=list(STRATEGIES))
+    suite.add_argument('--fill-ratio', type=float, default=0.3, help='Share of the filesystem holding data')
+    suite.add_argument('--pattern', choices=PATTERNS, default='random')
+    suite.add_argument('--block-kb', type=int, default=4096)
+    suite.add_argument('--depth', type=int, default=1)
+    suite.add_argument('--fanout-targets', type=int, default=2)
+    suite.add_argument('--baseline', help='Report of an earlier run to compare against')
+    suite.add_argument('--tolerance', type=float, default=0.1, help='Allowed MB/s drop against the baseline')
+    args = parser.parse_args()
+
+    if not args.qemu_img and not args.suite:
+        parser.error('qemu-img not found, pass --qemu-img')
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='imgwriter-bench-')
+    try:
+        if args.suite:
+            results = bench_suite(
+                args.strategies, args.size_mb * MB, args.fill_ratio, args.pattern, workdir, args.qemu_img,
+                args.block_kb * 1024, args.depth, args.fanout_targets
+            )
+        else:
+            results = bench_profiles(args.profiles, args.size_mb * MB, args.zero_ratio, workdir, args.qemu_img)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = results
+    if args.suite:
+        report = {
+            'created': time.time(),
+            'config': {
+                key: getattr(args, key)
+                for key in ('size_mb', 'strategies', 'fill_ratio', 'pattern', 'block_kb', 'depth', 'fanout_targets')
+            },
+            'results': results,
+        }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    if args.suite and args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
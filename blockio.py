@@ -0,0 +1,72 @@
+IO_PROFILES = {
+    'default': {
+        'target': {},
+        # parallel jobs share the image, a second read-write open hits QEMU's image locking
+        'source': {'readonly': 'on'},
+    },
+    'direct': {
+        'target': {'cache': 'none', 'aio': 'native', 'discard': 'unmap', 'detect-zeroes': 'unmap'},
+        'source': {'readonly': 'on', 'cache': 'writeback'},
+    },
+    'direct-uring': {
+        'target': {'cache': 'none', 'aio': 'io_uring', 'discard': 'unmap', 'detect-zeroes': 'unmap'},
+        'source': {'readonly': 'on', 'cache': 'writeback'},
+    },
+    'direct-threads': {
+        'target': {'cache': 'none', 'aio': 'threads', 'discard': 'unmap', 'detect-zeroes': 'unmap'},
+        'source': {'readonly': 'on', 'cache': 'writeback'},
+    },
+    'writeback-unmap': {
+        'target': {'cache': 'writeback', 'discard': 'unmap', 'detect-zeroes': 'unmap'},
+        'source': {'readonly': 'on'},
+    },
+}
+
+CACHE_MODES = {
+    'writeback': {'cache.direct': 'off', 'cache.no-flush': 'off'},
+    'none': {'cache.direct': 'on', 'cache.no-flush': 'off'},
+    'writethrough': {'cache.direct': 'off', 'cache.no-flush': 'off'},
+    'directsync': {'cache.direct': 'on', 'cache.no-flush': 'off'},
+    'unsafe': {'cache.direct': 'off', 'cache.no-flush': 'on'},
+}
+
+
+def get_profile(name):
+    if name not in IO_PROFILES:
+        raise ValueError(f'Unknown I/O profile: {name}')
+    return IO_PROFILES[name]
+
+
+def validate_options(options):
+    if options.get('aio') == 'native' and options.get('cache') not in ('none', 'directsync'):
+        raise ValueError('aio=native requires cache=none or cache=directsync')
+    if options.get('detect-zeroes') == 'unmap' and options.get('discard') != 'unmap':
+        raise ValueError('detect-zeroes=unmap requires discard=unmap')
+    if options.get('cache') and options['cache'] not in CACHE_MODES:
+        raise ValueError(f"Unknown cache mode: {options['cache']}")
+
+
+def drive_spec(path, drive_id, role, profile='default', fmt='raw'):
+    options = get_profile(profile)[role]
+    validate_options(options)
+    spec = f'file={path},if=none,id={drive_id},format={fmt}'
+    for key, value in options.items():
+        spec += f',{key}={value}'
+    return spec
+
+
+def image_opts(path, role, profile='default', fmt='raw', driver='file'):
+    options = dict(get_profile(profile)[role])
+    validate_options(options)
+    opts = {
+        'driver': fmt,
+        'file.driver': driver,
+        'file.filename': path,
+    }
+    opts.update(CACHE_MODES[options.pop('cache', 'writeback')])
+    if 'aio' in options:
+        opts['file.aio'] = options.pop('aio')
+    if options.pop('readonly', 'off') == 'on':
+        opts['read-only'] = 'on'
+    opts.update(options)
+    return ','.join(f'{key}={value}' for key, value in opts.items())
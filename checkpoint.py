@@ -0,0 +1,115 @@
+import json
+import os
+import re
+import threading
+import time
+
+from station import station_dir
+
+SEGMENT_MARKER = 'SEGMENT_DONE'
+VERIFY_MARKER = 'VERIFY_DONE'
+
+
+def marker(name):
+    return name.replace('_', '_""', 1)
+
+
+def image_identity(path, digest=None):
+    if digest:
+        return digest
+    stat = os.stat(path)
+    return f'{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}'
+
+
+def dd_command(offset, length, block_bytes, depth=1, conv='fsync', source='/dev/sdc', target='/dev/sdb'):
+    skip = offset // block_bytes
+    count = (length + block_bytes - 1) // block_bytes
+    if depth <= 1 or count < 2:
+        return f'dd if={source} of={target} bs={block_bytes} skip={skip} seek={skip} count={count} conv={conv}; s=$?'
+    stripes = []
+    step = (count + depth - 1) // depth
+    for start in range(skip, skip + count, step):
+        stripes.append(
+            f'dd if={source} of={target} bs={block_bytes} skip={start} seek={start} '
+            f'count={min(step, skip + count - start)} conv={conv} & p{len(stripes)}=$!'
+        )
+    waits = '; '.join(f'wait $p{i} || s=1' for i in range(len(stripes)))
+    return f"s=0; {'; '.join(stripes)}; {waits}"
+
+
+def segment_command(offset, length, block_bytes, sparse=False, depth=1, source='/dev/sdc', target='/dev/sdb'):
+    conv = 'fsync,sparse' if sparse else 'fsync'
+    return f'{dd_command(offset, length, block_bytes, depth, conv, source, target)}; echo {marker(SEGMENT_MARKER)} $s'
+
+
+def verify_command(offset, block_bytes, source='/dev/sdc', target='/dev/sdb'):
+    skip = offset // block_bytes - 1
+    read = 'dd if={} bs={} skip={} count=1 2>/dev/null | md5sum'
+    return (
+        f'[ "$({read.format(source, block_bytes, skip)})" = "$({read.format(target, block_bytes, skip)})" ]; '
+        f'echo {marker(VERIFY_MARKER)} $?'
+    )
+
+
+def split_segments(ranges, segment_bytes):
+    segments = []
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            step = min(segment_bytes - offset % segment_bytes, end - offset)
+            segments.append((offset, step))
+            offset += step
+    return segments
+
+
+def next_segment(segments, offset):
+    for start, length in segments:
+        end = start + length
+        if end > offset:
+            start = max(start, offset)
+            return start, end - start
+    return None
+
+
+def bytes_before(segments, offset):
+    return sum(max(0, min(start + length, offset) - start) for start, length in segments)
+
+
+class CheckpointStore:
+    _lock = threading.Lock()
+
+    def __init__(self, root):
+        self.root = root if os.path.isabs(root) else os.path.join(station_dir(), root)
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, serial):
+        return os.path.join(self.root, f"{re.sub(r'[^A-Za-z0-9_.-]', '_', serial)}.json")
+
+    def exists(self, serial):
+        return bool(serial) and os.path.exists(self.path(serial))
+
+    def load(self, serial, identity):
+        try:
+            with open(self.path(serial), 'r', encoding='utf-8') as f:
+                checkpoint = json.load(f)
+        except (OSError, ValueError):
+            return 0
+        if checkpoint.get('serial') != serial or checkpoint.get('identity') != identity:
+            return 0
+        return checkpoint.get('offset', 0)
+
+    def save(self, serial, identity, offset):
+        path = self.path(serial)
+        tmp_path = f'{path}.tmp'
+        with self._lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'serial': serial, 'identity': identity, 'offset': offset, 'updated': time.time()}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+
+    def clear(self, serial):
+        try:
+            os.remove(self.path(serial))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import yaml
+
+try:
+    import paramiko
+except ImportError:
+    paramiko = None
+
+RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'jobs.py')
+
+
+class LocalTransport:
+    def __init__(self, command=None, cwd=None):
+        self.command = command or [sys.executable, RUNNER]
+        self.cwd = cwd
+
+    def execute(self, args, on_line):
+        process = subprocess.Popen(
+            self.command + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=self.cwd,
+            text=True, encoding='utf-8', errors='replace'
+        )
+        for line in process.stdout:
+            on_line(line.rstrip('\r\n'))
+        return process.wait()
+
+
+class SSHTransport:
+    def __init__(self, host, user=None, port=22, key_file=None, password=None, command=None, trust_new_hosts=False,
+                 timeout=10, cwd=None):
+        if paramiko is None:
+            raise RuntimeError('paramiko is required for SSH stations')
+        self.host = host
+        self.user = user
+        self.port = port
+        self.key_file = os.path.expanduser(key_file) if key_file else None
+        self.password = password
+        self.command = command or ['python', 'jobs.py']
+        self.trust_new_hosts = trust_new_hosts
+        self.timeout = timeout
+        self.cwd = cwd
+        self.client = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        with self.lock:
+            transport = self.client.get_transport() if self.client else None
+            if transport is None or not transport.is_active():
+                client = paramiko.SSHClient()
+                client.load_system_host_keys()
+                client.set_missing_host_key_policy(
+                    paramiko.AutoAddPolicy() if self.trust_new_hosts else paramiko.RejectPolicy()
+                )
+                client.connect(
+                    self.host, port=self.port, username=self.user, key_filename=self.key_file,
+                    password=self.password, timeout=self.timeout
+                )
+                self.client = client
+            return self.client
+
+    def execute(self, args, on_line):
+        # passed to jobs.py rather than a cd, the remote shell may be cmd, PowerShell or sh
+        cwd = ['--cwd', self.cwd] if self.cwd else []
+        _, stdout, _ = self.connect().exec_command(subprocess.list2cmdline(self.command + cwd + args))
+        stdout.channel.set_combine_stderr(True)
+        for line in stdout:
+            on_line(line.rstrip('\r\n'))
+        return stdout.channel.recv_exit_status()
+
+
+def make_transport(spec):
+    if spec.get('host'):
+        return SSHTransport(
+            spec['host'], spec.get('user'), spec.get('port', 22), spec.get('key_file'), spec.get('password'),
+            spec.get('command'), spec.get('trust_new_hosts', False), cwd=spec.get('cwd')
+        )
+    return LocalTransport(spec.get('command'), spec.get('cwd'))
+
+
+class Station:
+    def __init__(self, name, transport, slots=None, alpha=0.3):
+        self.name = name
+        self.transport = transport
+        self.slots = slots
+        self.alpha = alpha
+        self.devices = []
+        self.running = 0
+        self.throughput = None
+        self.down = None
+
+    @property
+    def free(self):
+        if self.down:
+            return 0
+        if self.slots is None:
+            return len(self.devices)
+        return min(len(self.devices), self.slots - self.running)
+
+    def refresh(self):
+        lines = []
+        try:
+            code = self.transport.execute(['disks'], lines.append)
+            if code:
+                raise RuntimeError('\n'.join(lines[-5:]) or f'exit code {code}')
+            disks = json.loads(lines[-1])
+        except Exception as e:
+            self.down = str(e)
+            self.devices = []
+            return
+        self.down = None
+        self.devices = [disk['device'] for disk in disks if disk['flashable']]
+
+    def record(self, mb_per_second):
+        if self.throughput is None:
+            self.throughput = mb_per_second
+        else:
+            self.throughput += self.alpha * (mb_per_second - self.throughput)
+
+
+class Coordinator:
+    def __init__(self, stations, jobs, max_attempts=2, report=print):
+        self.stations = stations
+        self.pending = [dict(job, attempts=[]) for job in jobs]
+        self.results = []
+        self.max_attempts = max_attempts
+        self.report = report
+        self.running = 0
+        self.condition = threading.Condition()
+
+    def candidates(self, job):
+        tried = {attempt['station'] for attempt in job['attempts']}
+        stations = [s for s in self.stations if s.free > 0 and s.name not in tried]
+        if job.get('station'):
+            stations = [s for s in stations if s.name == job['station']]
+        if job.get('device'):
+            stations = [s for s in stations if job['device'] in s.devices]
+        return stations
+
+    def pick(self, job):
+        stations = self.candidates(job)
+        if not stations:
+            return None
+        # stations without a measured rate go first so every station gets sampled
+        return max(stations, key=lambda s: (s.throughput is None, s.throughput or 0, s.free))
+
+    def assign(self):
+        for job in list(self.pending):
+            station = self.pick(job)
+            if not station:
+                continue
+            device = job['device'] if job.get('device') else station.devices[0]
+            station.devices.remove(device)
+            station.running += 1
+            self.running += 1
+            self.pending.remove(job)
+            threading.Thread(target=self.execute, args=(station, device, job), daemon=True).start()
+
+    def execute(self, station, device, job):
+        args = ['run', device, str(job['management_id']), str(job['device_id'])]
+        if job.get('image_version'):
+            args += ['--image-version', str(job['image_version'])]
+        label = f'[{station.name} {device}]'
+        result = {}
+
+        def on_line(line):
+            try:
+                event = json.loads(line)
+            except ValueError:
+                self.report(f'{label} {line}')
+                return
+            if event.get('event') == 'log':
+                self.report(f"{label} {event['message']}")
+            elif event.get('event') == 'progress':
+                self.report(f"{label} {event['state']} {event['percent']}%")
+            elif event.get('event') in ('status', 'result'):
+                result.update(event)
+
+        started = time.time()
+        try:
+            code = station.transport.execute(args, on_line)
+        except Exception as e:
+            code = None
+            result.update(status='failed', failure=f'{type(e).__name__}: {e}')
+            station.down = str(e)
+        attempt = {
+            'station': station.name,
+            'device': device,
+            'status': result.get('status', 'failed') if code is not None else 'failed',
+            'failure': result.get('failure') or (f'exit code {code}' if code else None),
+            'bytes_written': result.get('bytes_written'),
+            'seconds': round(time.time() - started, 1),
+            'job_uuid': result.get('job_uuid'),
+        }
+        if attempt['status'] == 'success' and attempt['bytes_written'] and result.get('finished'):
+            station.record(attempt['bytes_written'] / 1024 / 1024 / max(result['finished'] - result['started'], 1))
+        self.report(f"{label} {attempt['status']} {attempt['failure'] or ''}".rstrip())
+        with self.condition:
+            job['attempts'].append(attempt)
+            station.running -= 1
+            self.running -= 1
+            if attempt['status'] == 'success' or len(job['attempts']) >= self.max_attempts:
+                self.results.append(job)
+            else:
+                self.pending.append(job)
+            self.condition.notify_all()
+
+    def run(self):
+        for station in self.stations:
+            station.refresh()
+            if station.down:
+                self.report(f'[{station.name}] unavailable: {station.down}')
+            else:
+                self.report(f'[{station.name}] {len(station.devices)} free disks')
+        with self.condition:
+            refreshed = True
+            while self.pending or self.running:
+                self.assign()
+                if self.running:
+                    refreshed = False
+                    self.condition.wait(5)
+                    continue
+                if not self.pending:
+                    break
+                if refreshed:
+                    for job in self.pending:
+                        self.results.append(job)
+                        self.report(f"{job['management_id']}/{job['device_id']}: no station available")
+                    self.pending = []
+                    break
+                for station in self.stations:
+                    station.refresh()
+                refreshed = True
+        return self.results
+
+
+def load_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        manifest = yaml.safe_load(f)
+    stations = [
+        Station(spec['name'], make_transport(spec), spec.get('slots'))
+        for spec in manifest['stations']
+    ]
+    return stations, manifest['jobs'], manifest.get('max_attempts', 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Spread a batch of flash jobs across several stations.')
+    parser.add_argument('manifest')
+    parser.add_argument('--output', help='Write the per-job results to this JSON file')
+    args = parser.parse_args()
+
+    stations, jobs, max_attempts = load_manifest(args.manifest)
+    results = Coordinator(stations, jobs, max_attempts).run()
+    failed = [job for job in results if not job['attempts'] or job['attempts'][-1]['status'] != 'success']
+    print(f'{len(results) - len(failed)}/{len(results)} jobs succeeded')
+    for station in stations:
+        rate = f'{station.throughput:.1f}MB/s' if station.throughput else '-'
+        print(f'{station.name:<16} {rate}')
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import argparse
+import errno
+import os
+import struct
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+BLKGETSIZE64 = 0x80081272
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+ALIGNMENT = 1024 * 1024
+DEFAULT_BATCH = 1024 * 1024 * 1024
+DONE_MARKER = 'PREFLASH_DONE'
+
+
+def align_up(value, alignment=ALIGNMENT):
+    return (value + alignment - 1) // alignment * alignment
+
+
+def align_down(value, alignment=ALIGNMENT):
+    return value // alignment * alignment
+
+
+def device_size(fd):
+    buf = fcntl.ioctl(fd, BLKGETSIZE64, b'\0' * 8)
+    return struct.unpack('Q', buf)[0]
+
+
+def uncovered_ranges(size, covered):
+    ranges = []
+    position = 0
+    for offset, length in sorted(covered):
+        start = align_down(offset)
+        if start > position:
+            ranges.append((position, start - position))
+        position = max(position, align_up(offset + length))
+    if position < size:
+        ranges.append((position, size - position))
+    return ranges
+
+
+def tail_ranges(path, offset):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return uncovered_ranges(device_size(fd), [(0, offset)])
+    finally:
+        os.close(fd)
+
+
+def batch_ranges(ranges, batch_size=DEFAULT_BATCH):
+    for offset, length in ranges:
+        end = offset + length
+        while offset < end:
+            step = min(batch_size, end - offset)
+            yield offset, step
+            offset += step
+
+
+def discard_ranges(path, ranges=None, mode='discard', batch_size=DEFAULT_BATCH, stop=None):
+    if fcntl is None:
+        raise RuntimeError('Block device ioctls are only available on Linux')
+    start = time.monotonic()
+    fd = os.open(path, os.O_RDWR)
+    stats = {'mode': mode, 'bytes': 0, 'batches': 0, 'discarded': 0, 'stopped': False}
+    try:
+        if ranges is None:
+            ranges = [(0, device_size(fd))]
+        for offset, length in batch_ranges(ranges, batch_size):
+            if stop and stop.is_set():
+                stats['stopped'] = True
+                break
+            request = BLKDISCARD if stats['mode'] == 'discard' else BLKZEROOUT
+            try:
+                fcntl.ioctl(fd, request, struct.pack('QQ', offset, length))
+            except OSError as e:
+                if stats['mode'] != 'discard' or e.errno not in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                    raise
+                stats['mode'] = 'zeroout'
+                fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', offset, length))
+            if stats['mode'] == 'discard':
+                stats['discarded'] += length
+            stats['bytes'] += length
+            stats['batches'] += 1
+    finally:
+        os.close(fd)
+    stats['seconds'] = time.monotonic() - start
+    return stats
+
+
+def guest_preflash_command(device, mode='discard', offset=0, batch_size=DEFAULT_BATCH):
+    offset = align_up(offset)
+    zeroout = f'blkdiscard -z -p {batch_size} -o {offset} {device}'
+    if mode == 'zeroout':
+        command = zeroout
+    else:
+        command = f'blkdiscard -p {batch_size} -o {offset} {device} || {zeroout}'
+    marker = DONE_MARKER.replace('_', '_""', 1)
+    return f'{command}; echo {marker} $?'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Discard or zero out a block device before flashing.')
+    parser.add_argument('device')
+    parser.add_argument('--mode', choices=['discard', 'zeroout'], default='discard')
+    parser.add_argument('--offset', type=int, default=0, help='Keep the first OFFSET bytes, e.g. the image size')
+    parser.add_argument('--batch-mb', type=int, default=DEFAULT_BATCH // 1024 // 1024)
+    args = parser.parse_args()
+
+    ranges = tail_ranges(args.device, args.offset) if args.offset else None
+    stats = discard_ranges(args.device, ranges, args.mode, args.batch_mb * 1024 * 1024)
+    print(f"{stats['mode']}: {stats['bytes'] / 1024 / 1024:.0f} MB in {stats['batches']} batches, {stats['seconds']:.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+import re
+import subprocess
+
+DETAIL_FIELDS = [
+    'disk_id', 'type', 'status', 'path', 'target', 'lun_id',
+    'location_path', 'current_readonly_state', 'readonly', 'boot_disk',
+    'pagefile_disk', 'hibernation_file_disk', 'crashdump_disk', 'clustered_disk'
+]
+DISK_PATTERN = re.compile(
+    r"^(\*?)\s+(\w+)\s+(\d+)\s+(\w+)\s+(\d+\s+\w+)\s+(\d+\s+\w+)(?:\s+(\w*))?(?:\s+(\*?))?\r?$", re.MULTILINE
+)
+PHYSICALDRIVE_PATTERN = re.compile(r'PHYSICALDRIVE(\d+)$', re.IGNORECASE)
+# MSFT_PhysicalDisk.HealthStatus: 0 Healthy, 1 Warning, 2 Unhealthy, 5 Unknown
+HEALTH_STATUS = {0: 'passed', 1: 'failed', 2: 'failed'}
+
+
+def run_diskpart(commands):
+    process = subprocess.Popen(["diskpart"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, _ = process.communicate(input=commands.encode())
+    return stdout.decode('gbk', errors='ignore')
+
+
+def has_partitions(index):
+    return '###' in run_diskpart(f"select disk {index}\ndetail disk\n")
+
+
+def diskpart_disks(log=None):
+    physical_disks = []
+    for disk in DISK_PATTERN.findall(run_diskpart("list disk\n")):
+        current, drive, index, status, size, free, dyn, gpt = disk
+        disk_info = {
+            'has_partitions': True,
+            'current': True if current else False,
+            'device': f'\\\\.\\PHYSICALDRIVE{index}',
+            'index': index,
+            'status': status,
+            'size': size,
+            'free': free,
+            'dyn': dyn,
+            'gpt': True if gpt else False
+        }
+
+        detail_output = run_diskpart(f"select disk {index}\ndetail disk\n")
+        if '###' not in detail_output:
+            disk_info['has_partitions'] = False
+        detail_lines = detail_output.splitlines()
+        start_index = 0
+        count = 0
+        for i, line in enumerate(detail_lines):
+            if line == 'DISKPART> ':
+                count += 1
+            if count == 2:
+                disk_info['model'] = detail_lines[i + 1].strip()
+                start_index = i + 2
+                break
+
+        detail_lines = detail_lines[start_index:]
+        for i, line in enumerate(detail_lines[:len(DETAIL_FIELDS)]):
+            parts = line.split(":", 1)
+            if len(parts) == 2:
+                disk_info[DETAIL_FIELDS[i]] = parts[1].strip()
+        if log:
+            log(f'扫描到{drive}{index}: ' + ', '.join(f'{key}: {value}' for key, value in disk_info.items()))
+
+        physical_disks.append(disk_info)
+    return physical_disks
+
+
+def wmi_disks():
+    import win32com.client
+
+    physical_disks = []
+    c = win32com.client.Dispatch("WbemScripting.SWbemLocator")
+    connection = c.ConnectServer(".", r"root\cimv2")
+    for disk in connection.ExecQuery("Select * from Win32_DiskDrive"):
+        physical_disks.append({
+            'device': disk.DeviceID,
+            'index': disk.Index,
+            'manufacturer': disk.Manufacturer,
+            'model': disk.Model,
+            'size': f'{int(int(disk.Size if disk.Size else 0) // (1024 ** 3))}GB',
+            'serial_number': (disk.SerialNumber or '').strip(),
+            'has_partitions': has_partitions(disk.Index),
+            'current': False,
+        })
+    return physical_disks
+
+
+def wmi_smart(index):
+    import pythoncom
+    import win32com.client
+
+    pythoncom.CoInitialize()
+    try:
+        c = win32com.client.Dispatch("WbemScripting.SWbemLocator")
+        connection = c.ConnectServer(".", r"root\Microsoft\Windows\Storage")
+        for disk in connection.ExecQuery(f"Select HealthStatus from MSFT_PhysicalDisk where DeviceId = '{index}'"):
+            return HEALTH_STATUS.get(disk.HealthStatus, 'unavailable')
+    finally:
+        pythoncom.CoUninitialize()
+    return 'unavailable'
+
+
+def smartctl_smart(device, timeout=15):
+    match = PHYSICALDRIVE_PATTERN.search(device)
+    if match:
+        device = f'/dev/pd{match.group(1)}'
+    try:
+        result = subprocess.run(
+            ['smartctl', '-H', device], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace',
+            timeout=timeout
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return 'unavailable'
+    # exit status bit 3: SMART status check returned "DISK FAILING"
+    if result.returncode & 8 or 'FAILED' in result.stdout:
+        return 'failed'
+    if 'PASSED' in result.stdout or re.search(r'Health Status:\s*OK', result.stdout):
+        return 'passed'
+    return 'unavailable'
+
+
+def smart_status(device):
+    match = PHYSICALDRIVE_PATTERN.search(device)
+    if match:
+        try:
+            status = wmi_smart(match.group(1))
+        except Exception:
+            status = 'unavailable'
+        if status != 'unavailable':
+            return status
+    return smartctl_smart(device)
+
+
+def list_disks(log=None):
+    try:
+        return wmi_disks()
+    except ImportError:
+        return diskpart_disks(log)
+
+
+def flashable_disks(checkpoints, log=None):
+    disks = list_disks(log)
+    for disk in disks:
+        disk['flashable'] = not disk['current'] and (
+            not disk['has_partitions'] or checkpoints.exists(disk.get('serial_number'))
+        )
+    return disks
@@ -0,0 +1,248 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from queue import Empty, Full, Queue
+
+from imageinfo import analyze, open_image
+
+SECTOR_SIZE = 512
+DEFAULT_CHUNK = 4 * 1024 * 1024
+
+
+class Chunk:
+    def __init__(self, pool, size):
+        self.pool = pool
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+        self.length = 0
+        self.refs = 0
+        self.lock = threading.Lock()
+
+    def data(self):
+        return self.view[:self.length]
+
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+        self.pool.put(self)
+
+
+class BufferPool:
+    def __init__(self, count, size):
+        self.free = Queue()
+        for _ in range(count):
+            self.free.put(Chunk(self, size))
+
+    def acquire(self):
+        return self.free.get()
+
+    def put(self, chunk):
+        self.free.put(chunk)
+
+
+def open_target(path):
+    return os.open(path, os.O_WRONLY | getattr(os, 'O_BINARY', 0))
+
+
+def write_at(fd, data, offset):
+    if hasattr(os, 'pwrite'):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+        return
+    os.lseek(fd, offset, os.SEEK_SET)
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+class TargetWriter(threading.Thread):
+    def __init__(self, path, max_lag):
+        super().__init__(daemon=True)
+        self.path = path
+        self.chunks = Queue(maxsize=max_lag)
+        self.bytes_written = 0
+        self.error = None
+        self.started = time.monotonic()
+        self.finished = None
+        self.last_progress = self.started
+
+    @property
+    def alive(self):
+        return self.error is None
+
+    def submit(self, chunk, timeout):
+        try:
+            self.chunks.put(chunk, timeout=timeout)
+            return True
+        except Full:
+            return False
+
+    def fail(self, error):
+        if self.error is None:
+            self.error = error
+        while True:
+            try:
+                chunk = self.chunks.get_nowait()
+            except Empty:
+                return
+            if chunk is not None:
+                chunk.release()
+
+    def run(self):
+        try:
+            fd = open_target(self.path)
+        except OSError as e:
+            self.fail(e)
+            fd = None
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if fd is not None and self.alive:
+                try:
+                    write_at(fd, chunk.data(), chunk.offset)
+                    self.bytes_written += chunk.length
+                    self.last_progress = time.monotonic()
+                except OSError as e:
+                    self.error = e
+            chunk.release()
+        if fd is not None:
+            self.last_progress = time.monotonic()
+            try:
+                if self.alive:
+                    os.fsync(fd)
+            except OSError as e:
+                self.error = e
+            finally:
+                os.close(fd)
+        self.finished = time.monotonic()
+
+
+class FanoutWriter:
+    def __init__(self, source, targets, ranges=None, chunk_size=DEFAULT_CHUNK, pool_size=16, max_lag=8,
+                 stall_timeout=60):
+        self.source = source
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.pool = BufferPool(max(pool_size, max_lag + 2), chunk_size)
+        self.stall_timeout = stall_timeout
+        self.writers = [TargetWriter(target, max_lag) for target in targets]
+        self.bytes_read = 0
+
+    def chunks(self, size):
+        for offset, length in self.ranges or [(0, size)]:
+            end = min(offset + length, size)
+            while offset < end:
+                step = min(self.chunk_size, end - offset)
+                yield offset, step
+                offset += step
+
+    def dispatch(self, chunk):
+        alive = [w for w in self.writers if w.alive]
+        chunk.refs = len(alive) + 1
+        for writer in alive:
+            while not writer.submit(chunk, timeout=1):
+                if not writer.alive:
+                    chunk.release()
+                    break
+                if self.check_stall(writer):
+                    chunk.release()
+                    break
+        chunk.release()
+
+    def check_stall(self, writer):
+        if time.monotonic() - writer.last_progress > self.stall_timeout:
+            writer.fail(TimeoutError(f'{writer.path} stalled for {self.stall_timeout}s'))
+            return True
+        return False
+
+    def run(self, progress=None):
+        for writer in self.writers:
+            writer.start()
+        with open_image(self.source) as image:
+            size = image.size
+            for offset, length in self.chunks(size):
+                if not any(w.alive for w in self.writers):
+                    break
+                chunk = self.pool.acquire()
+                read = image.readinto(offset, chunk.view[:length])
+                padded = (read + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+                chunk.view[read:padded] = bytes(padded - read)
+                chunk.offset = offset
+                chunk.length = padded
+                self.bytes_read += read
+                self.dispatch(chunk)
+                if progress:
+                    progress(offset + read, size, self.writers)
+        for writer in self.writers:
+            while writer.alive and not writer.submit(None, timeout=1):
+                self.check_stall(writer)
+            if not writer.alive:
+                try:
+                    writer.chunks.put_nowait(None)
+                except Full:
+                    pass
+        for writer in self.writers:
+            # a dropped writer may be stuck in the kernel for good, it is a daemon thread and left behind
+            while writer.alive and writer.is_alive():
+                writer.join(1)
+                if writer.is_alive():
+                    self.check_stall(writer)
+        return [
+            {
+                'target': w.path,
+                'bytes': w.bytes_written,
+                'seconds': (w.finished or time.monotonic()) - w.started,
+                'error': str(w.error) if w.error else None,
+            }
+            for w in self.writers
+        ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write one image to several disks, reading it only once.')
+    parser.add_argument('image')
+    parser.add_argument('targets', nargs='+')
+    parser.add_argument('--chunk-mb', type=int, default=DEFAULT_CHUNK // 1024 // 1024)
+    parser.add_argument('--pool', type=int, default=16)
+    parser.add_argument('--max-lag', type=int, default=8)
+    parser.add_argument('--stall-timeout', type=float, default=60)
+    parser.add_argument('--used-only', action='store_true', help='Copy only allocated ext blocks and metadata')
+    parser.add_argument(
+        '--zeroed-targets', action='store_true',
+        help='Targets read back zeros (e.g. after blkdiscard -z), also skip qcow2 clusters that are not stored'
+    )
+    args = parser.parse_args()
+
+    ranges = None
+    if args.used_only or args.zeroed_targets:
+        with open_image(args.image) as image:
+            ranges = analyze(image, SECTOR_SIZE * 8, zeroed=args.zeroed_targets)['ranges']
+
+    def progress(done, size, writers):
+        failed = sum(1 for w in writers if not w.alive)
+        sys.stdout.write(f'\r{done * 100 // size:>3}%  {len(writers) - failed}/{len(writers)} targets')
+        sys.stdout.flush()
+
+    writer = FanoutWriter(
+        args.image, args.targets, ranges, chunk_size=args.chunk_mb * 1024 * 1024,
+        pool_size=args.pool, max_lag=args.max_lag, stall_timeout=args.stall_timeout
+    )
+    results = writer.run(progress)
+    print()
+    for result in results:
+        rate = result['bytes'] / result['seconds'] / 1024 / 1024 if result['seconds'] else 0
+        status = result['error'] or 'ok'
+        print(f"{result['target']:<28} {result['bytes'] / 1024 / 1024:>10.0f}MB {rate:>8.1f}MB/s  {status}")
+    sys.exit(1 if any(r['error'] for r in results) else 0)
+
+
+if __name__ == '__main__':
+    main()
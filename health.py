@@ -0,0 +1,51 @@
+import random
+
+from checkpoint import marker
+
+HEALTH_MARKER = 'HEALTH_DONE'
+UPTIME = "$(cut -d' ' -f1 /proc/uptime)"
+MB = 1024 * 1024
+
+
+def probe_command(seq_read_mb, write_mb, random_reads, device='/dev/sdb', rng=random):
+    points = ' '.join(str(rng.randrange(1000)) for _ in range(random_reads))
+    reads = (
+        f'for p in {points}; do dd if=$d of=/dev/null bs=4096 count=1 skip=$((n / 4096 * p / 1000)) '
+        f'iflag=direct 2>/dev/null || s=1; done'
+    )
+    return (
+        f'd={device}; n=$(blockdev --getsize64 $d); s=0; t0={UPTIME}; '
+        f'dd if=$d of=/dev/null bs=1M count={seq_read_mb} iflag=direct 2>/dev/null || s=1; t1={UPTIME}; '
+        f'{reads}; t2={UPTIME}; '
+        f'dd if=/dev/zero of=$d bs=1M count={write_mb} seek=$((n / {MB} - {write_mb})) oflag=direct conv=fsync '
+        f'2>/dev/null || s=1; t3={UPTIME}; '
+        f'echo {marker(HEALTH_MARKER)} $s $t0 $t1 $t2 $t3'
+    )
+
+
+def measure(config, smart, status, t0, t1, t2, t3):
+    t0, t1, t2, t3 = (float(t) for t in (t0, t1, t2, t3))
+    return {
+        'io_error': status != '0',
+        'read_mbps': round(config['seq_read_mb'] / max(t1 - t0, 0.01), 1),
+        'random_ms': round((t2 - t1) * 1000 / max(config['random_reads'], 1), 1),
+        'write_mbps': round(config['write_mb'] / max(t3 - t2, 0.01), 1),
+        'smart': smart,
+    }
+
+
+def evaluate(metrics, config):
+    reasons = []
+    if metrics['io_error']:
+        reasons.append('读写出错')
+    if metrics['smart'] == 'failed':
+        reasons.append('SMART状态异常')
+    elif metrics['smart'] == 'unavailable' and config['require_smart']:
+        reasons.append('无法读取SMART')
+    if metrics['read_mbps'] < config['min_read_mbps']:
+        reasons.append(f"顺序读{metrics['read_mbps']}MB/s低于{config['min_read_mbps']}MB/s")
+    if metrics['write_mbps'] < config['min_write_mbps']:
+        reasons.append(f"顺序写{metrics['write_mbps']}MB/s低于{config['min_write_mbps']}MB/s")
+    if metrics['random_ms'] > config['max_random_ms']:
+        reasons.append(f"随机读{metrics['random_ms']}ms高于{config['max_random_ms']}ms")
+    return reasons
@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import struct
+
+from qcow2 import QCOW2_MAGIC, Qcow2Image
+
+SECTOR_SIZE = 512
+EXT_MAGIC = 0xEF53
+GPT_SIGNATURE = b'EFI PART'
+MBR_PROTECTIVE = 0xEE
+MBR_EXTENDED = (0x05, 0x0F, 0x85)
+
+INCOMPAT_META_BG = 0x10
+INCOMPAT_64BIT = 0x80
+RO_COMPAT_SPARSE_SUPER = 0x1
+RO_COMPAT_BIGALLOC = 0x200
+BG_BLOCK_UNINIT = 0x2
+
+
+class RawImage:
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb', buffering=0)
+        self.size = os.fstat(self.file.fileno()).st_size
+
+    def pread(self, offset, length):
+        self.file.seek(offset)
+        return self.file.read(length)
+
+    def readinto(self, offset, view):
+        self.file.seek(offset)
+        return self.file.readinto(view)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def image_format(path):
+    with open(path, 'rb') as f:
+        return 'qcow2' if f.read(4) == QCOW2_MAGIC else 'raw'
+
+
+def open_image(path):
+    return Qcow2Image(path) if image_format(path) == 'qcow2' else RawImage(path)
+
+
+def read_partitions(image):
+    mbr = image.pread(0, SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != b'\x55\xaa':
+        return []
+    partitions = []
+    for i in range(4):
+        entry = mbr[446 + i * 16:446 + (i + 1) * 16]
+        part_type = entry[4]
+        start, sectors = struct.unpack_from('<II', entry, 8)
+        if part_type == MBR_PROTECTIVE:
+            return read_gpt_partitions(image)
+        if part_type and sectors and part_type not in MBR_EXTENDED:
+            partitions.append({'start': start * SECTOR_SIZE, 'size': sectors * SECTOR_SIZE, 'type': f'{part_type:02x}'})
+    return partitions
+
+
+def read_gpt_partitions(image):
+    header = image.pread(SECTOR_SIZE, 92)
+    if header[:8] != GPT_SIGNATURE:
+        return []
+    entries_lba, count, entry_size = struct.unpack_from('<QII', header, 72)
+    table = image.pread(entries_lba * SECTOR_SIZE, count * entry_size)
+    partitions = []
+    for i in range(count):
+        entry = table[i * entry_size:(i + 1) * entry_size]
+        if len(entry) < 48 or entry[:16] == bytes(16):
+            continue
+        first, last = struct.unpack_from('<QQ', entry, 32)
+        partitions.append({
+            'start': first * SECTOR_SIZE,
+            'size': (last - first + 1) * SECTOR_SIZE,
+            'type': entry[:16].hex(),
+        })
+    return partitions
+
+
+def has_super(group, sparse_super):
+    if not sparse_super or group <= 1:
+        return True
+    for base in (3, 5, 7):
+        value = base
+        while value < group:
+            value *= base
+        if value == group:
+            return True
+    return False
+
+
+def ext_free_ranges(image, start, size):
+    sb = image.pread(start + 1024, 1024)
+    if len(sb) < 1024 or struct.unpack_from('<H', sb, 0x38)[0] != EXT_MAGIC:
+        return None
+    blocks_lo, = struct.unpack_from('<I', sb, 0x4)
+    first_data_block, log_block_size = struct.unpack_from('<II', sb, 0x14)
+    blocks_per_group, = struct.unpack_from('<I', sb, 0x20)
+    inodes_per_group, = struct.unpack_from('<I', sb, 0x28)
+    revision, = struct.unpack_from('<I', sb, 0x4C)
+    inode_size = struct.unpack_from('<H', sb, 0x58)[0] if revision else 128
+    incompat, ro_compat = struct.unpack_from('<II', sb, 0x60)
+    reserved_gdt_blocks, = struct.unpack_from('<H', sb, 0xCE)
+    if incompat & INCOMPAT_META_BG or ro_compat & RO_COMPAT_BIGALLOC:
+        return None
+    block_size = 1024 << log_block_size
+    blocks = blocks_lo
+    desc_size = 32
+    if incompat & INCOMPAT_64BIT:
+        blocks |= struct.unpack_from('<I', sb, 0x150)[0] << 32
+        desc_size = struct.unpack_from('<H', sb, 0xFE)[0] or 64
+    if blocks * block_size > size:
+        return None
+    groups = (blocks - first_data_block + blocks_per_group - 1) // blocks_per_group
+    gdt_blocks = (groups * desc_size + block_size - 1) // block_size
+    gdt = image.pread(start + (first_data_block + 1) * block_size, groups * desc_size)
+    sparse_super = ro_compat & RO_COMPAT_SPARSE_SUPER
+    inode_table_blocks = (inodes_per_group * inode_size + block_size - 1) // block_size
+
+    free = []
+    for group in range(groups):
+        desc = gdt[group * desc_size:(group + 1) * desc_size]
+        bitmap_block, inode_bitmap, inode_table = struct.unpack_from('<III', desc, 0)
+        flags, = struct.unpack_from('<H', desc, 0x12)
+        if desc_size >= 64:
+            high = struct.unpack_from('<III', desc, 0x20)
+            bitmap_block |= high[0] << 32
+            inode_bitmap |= high[1] << 32
+            inode_table |= high[2] << 32
+        group_start = first_data_block + group * blocks_per_group
+        group_blocks = min(blocks_per_group, blocks - group_start)
+        if flags & BG_BLOCK_UNINIT:
+            # no bitmap on disk: everything is free but the backup superblock, the GDT and,
+            # without flex_bg, the group's own bitmaps and inode table
+            used = [(0, 1 + gdt_blocks + reserved_gdt_blocks)] if has_super(group, sparse_super) else []
+            for block, count in ((bitmap_block, 1), (inode_bitmap, 1), (inode_table, inode_table_blocks)):
+                if group_start <= block < group_start + group_blocks:
+                    used.append((block - group_start, count))
+            free.extend((group_start + index, count) for index, count in subtract_ranges(group_blocks, used))
+            continue
+        bitmap = image.pread(start + bitmap_block * block_size, (group_blocks + 7) // 8)
+        free.extend((group_start + index, count) for index, count in bitmap_free_runs(bitmap, group_blocks))
+    return [(start + block * block_size, count * block_size) for block, count in free]
+
+
+def bitmap_free_runs(bitmap, count):
+    run_start = None
+    for byte_index, byte in enumerate(bitmap):
+        base = byte_index * 8
+        if byte == 0 and run_start is None:
+            run_start = base
+            continue
+        if byte == 0xFF or byte == 0:
+            if byte == 0xFF and run_start is not None:
+                yield run_start, base - run_start
+                run_start = None
+            continue
+        for bit in range(8):
+            used = byte >> bit & 1
+            if not used and run_start is None:
+                run_start = base + bit
+            elif used and run_start is not None:
+                yield run_start, base + bit - run_start
+                run_start = None
+    if run_start is not None and run_start < count:
+        yield run_start, count - run_start
+
+
+def subtract_ranges(size, holes):
+    ranges = []
+    position = 0
+    for offset, length in sorted(holes):
+        if offset > position:
+            ranges.append((position, offset - position))
+        position = max(position, offset + length)
+    if position < size:
+        ranges.append((position, size - position))
+    return ranges
+
+
+def align_ranges(ranges, alignment, size):
+    aligned = []
+    for offset, length in ranges:
+        start = offset // alignment * alignment
+        end = min((offset + length + alignment - 1) // alignment * alignment, size)
+        if aligned and start <= aligned[-1][1]:
+            aligned[-1][1] = max(aligned[-1][1], end)
+        else:
+            aligned.append([start, end])
+    return [(start, end - start) for start, end in aligned]
+
+
+def coalesce_ranges(ranges, max_gap):
+    merged = []
+    for offset, length in ranges:
+        if merged and offset - (merged[-1][0] + merged[-1][1]) <= max_gap:
+            merged[-1] = (merged[-1][0], offset + length - merged[-1][0])
+        else:
+            merged.append((offset, length))
+    return merged
+
+
+def free_ranges(image, partitions):
+    # only ext free space may keep stale data on the target; unallocated qcow2 clusters
+    # elsewhere read as zeros and must be written like any other data
+    holes = []
+    for partition in partitions:
+        free = ext_free_ranges(image, partition['start'], partition['size'])
+        partition['filesystem'] = 'ext' if free is not None else None
+        holes.extend(free or [])
+    return holes
+
+
+def analyze(image, alignment=4 * 1024 * 1024, max_gap=4 * 1024 * 1024, zeroed=False):
+    partitions = read_partitions(image)
+    holes = free_ranges(image, partitions)
+    if zeroed and hasattr(image, 'allocated_ranges'):
+        # a target that already reads back zeros needs none of the clusters qcow2 doesn't store
+        holes += subtract_ranges(image.size, image.allocated_ranges())
+    ranges = subtract_ranges(image.size, holes)
+    ranges = coalesce_ranges(align_ranges(ranges, alignment, image.size), max_gap)
+    return {
+        'size': image.size,
+        'alignment': alignment,
+        'max_gap': max_gap,
+        'partitions': partitions,
+        'ranges': ranges,
+        'bytes': sum(length for _, length in ranges),
+    }
+
+
+def copy_plan(path, alignment, max_gap, store=None, digest=None):
+    if store and digest:
+        cached = store.metadata(digest).get('copy_plan')
+        if cached and cached['alignment'] == alignment and cached['max_gap'] == max_gap:
+            cached['ranges'] = [tuple(r) for r in cached['ranges']]
+            return cached
+    with open_image(path) as image:
+        plan = analyze(image, alignment, max_gap)
+    if store and digest:
+        store.set_metadata(digest, 'copy_plan', plan)
+    return plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show the partitions and allocated ranges of a firmware image.')
+    parser.add_argument('image')
+    parser.add_argument('--alignment-mb', type=float, default=4)
+    parser.add_argument('--max-gap-mb', type=float, default=4)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    with open_image(args.image) as image:
+        plan = analyze(image, int(args.alignment_mb * 1024 * 1024), int(args.max_gap_mb * 1024 * 1024))
+    if args.json:
+        print(json.dumps(plan, indent=2))
+        return
+    for partition in plan['partitions']:
+        print(f"partition {partition['type']:>4} at {partition['start']:>14} size {partition['size']:>14} {partition['filesystem'] or ''}")
+    print(f"{len(plan['ranges'])} ranges, {plan['bytes'] / 1024 ** 2:.0f}MB of {plan['size'] / 1024 ** 2:.0f}MB")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from locking import file_lock
+from station import load_station_config, station_dir
+
+HASH_CHUNK = 8 * 1024 * 1024
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class ImageStore:
+    def __init__(self, root, budget_bytes=None):
+        self.root = root
+        self.budget_bytes = budget_bytes
+        self.index_path = os.path.join(root, 'index.json')
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+
+    def _lock(self):
+        # parallel jobs.py processes share the store, a thread lock is not enough
+        return file_lock(f'{self.index_path}.lock')
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return {'objects': {}, 'versions': {}, 'default': None}
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, index):
+        tmp_path = f'{self.index_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], f'{digest}.img')
+
+    def add(self, path, version, metadata=None, make_default=False):
+        digest = file_digest(path)
+        target = self.object_path(digest)
+        if not os.path.exists(target):
+            # copied outside the lock so running jobs can still resolve their images meanwhile
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            tmp_path = f'{target}.{os.getpid()}.tmp'
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+        with self._lock():
+            index = self._load()
+            if digest not in index['objects']:
+                index['objects'][digest] = {
+                    'size': os.path.getsize(target),
+                    'added': time.time(),
+                    'last_used': time.time(),
+                    'metadata': {},
+                }
+            index['objects'][digest]['metadata'].update(metadata or {})
+            index['versions'][version] = digest
+            if make_default or not index['default']:
+                index['default'] = version
+            self._save(index)
+        self.evict(keep=(digest,))
+        return digest
+
+    def resolve(self, version=None):
+        with self._lock():
+            index = self._load()
+            version = version or index['default']
+            digest = index['versions'].get(version)
+            if not digest:
+                return None, None
+            index['objects'][digest]['last_used'] = time.time()
+            try:
+                self._save(index)
+            except OSError:
+                # last_used only orders eviction, it must not fail the job
+                pass
+        return digest, self.object_path(digest)
+
+    def has_version(self, version):
+        with self._lock():
+            return version in self._load()['versions']
+
+    def metadata(self, digest):
+        with self._lock():
+            return self._load()['objects'].get(digest, {}).get('metadata', {})
+
+    def set_metadata(self, digest, key, value):
+        with self._lock():
+            index = self._load()
+            if digest not in index['objects']:
+                return
+            index['objects'][digest]['metadata'][key] = value
+            self._save(index)
+
+    def set_default(self, version):
+        with self._lock():
+            index = self._load()
+            if version not in index['versions']:
+                raise KeyError(version)
+            index['default'] = version
+            self._save(index)
+
+    def remove(self, version):
+        with self._lock():
+            index = self._load()
+            digest = index['versions'].pop(version, None)
+            if index['default'] == version:
+                index['default'] = next(iter(index['versions']), None)
+            if digest and digest not in index['versions'].values():
+                self._drop(index, digest)
+            self._save(index)
+
+    def _drop(self, index, digest):
+        index['objects'].pop(digest, None)
+        for version in [v for v, d in index['versions'].items() if d == digest]:
+            del index['versions'][version]
+        if index['default'] not in index['versions']:
+            index['default'] = next(iter(index['versions']), None)
+        try:
+            os.remove(self.object_path(digest))
+        except OSError:
+            pass
+
+    def evict(self, budget_bytes=None, keep=()):
+        budget_bytes = budget_bytes if budget_bytes is not None else self.budget_bytes
+        if budget_bytes is None:
+            return []
+        evicted = []
+        with self._lock():
+            index = self._load()
+            pinned = set(keep)
+            if index['default']:
+                pinned.add(index['versions'][index['default']])
+            total = sum(obj['size'] for obj in index['objects'].values())
+            candidates = sorted(
+                (d for d in index['objects'] if d not in pinned),
+                key=lambda d: index['objects'][d]['last_used']
+            )
+            for digest in candidates:
+                if total <= budget_bytes:
+                    break
+                total -= index['objects'][digest]['size']
+                self._drop(index, digest)
+                evicted.append(digest)
+            self._save(index)
+        return evicted
+
+    def list(self):
+        with self._lock():
+            index = self._load()
+        versions = []
+        for version, digest in sorted(index['versions'].items()):
+            obj = index['objects'][digest]
+            versions.append({
+                'version': version,
+                'digest': digest,
+                'size': obj['size'],
+                'last_used': obj['last_used'],
+                'default': version == index['default'],
+            })
+        return versions
+
+
+def open_station_store(config=None):
+    config = (config or load_station_config())['image_store']
+    root = config['path']
+    if not os.path.isabs(root):
+        root = os.path.join(station_dir(), root)
+    budget = config['budget_gb'] * 1024 ** 3 if config['budget_gb'] else None
+    return ImageStore(root, budget)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the local firmware image store.')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    add_parser = subparsers.add_parser('add')
+    add_parser.add_argument('path')
+    add_parser.add_argument('version')
+    add_parser.add_argument('--default', action='store_true')
+    subparsers.add_parser('list')
+    remove_parser = subparsers.add_parser('remove')
+    remove_parser.add_argument('version')
+    default_parser = subparsers.add_parser('default')
+    default_parser.add_argument('version')
+    gc_parser = subparsers.add_parser('gc')
+    gc_parser.add_argument('--budget-gb', type=float, default=None)
+    args = parser.parse_args()
+
+    store = open_station_store()
+    if args.action == 'add':
+        print(store.add(args.path, args.version, make_default=args.default))
+    elif args.action == 'list':
+        for item in store.list():
+            mark = '*' if item['default'] else ' '
+            print(f"{mark} {item['version']:<24} {item['digest'][:16]} {item['size'] / 1024 ** 2:>10.0f}MB")
+    elif args.action == 'remove':
+        store.remove(args.version)
+    elif args.action == 'default':
+        store.set_default(args.version)
+    elif args.action == 'gc':
+        budget = args.budget_gb * 1024 ** 3 if args.budget_gb is not None else None
+        for digest in store.evict(budget):
+            print(f'evicted {digest}')
+
+
+if __name__ == '__main__':
+    main()
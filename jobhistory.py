@@ -0,0 +1,216 @@
+import argparse
+import atexit
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from queue import Empty, Queue
+
+from station import load_station_config, station_dir
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    job_uuid TEXT PRIMARY KEY,
+    station TEXT,
+    slot TEXT,
+    model TEXT,
+    serial TEXT,
+    image_version TEXT,
+    image_digest TEXT,
+    started REAL,
+    finished REAL,
+    bytes_written INTEGER,
+    status TEXT,
+    failure TEXT,
+    stages TEXT
+)
+'''
+COLUMNS = (
+    'job_uuid', 'station', 'slot', 'model', 'serial', 'image_version', 'image_digest',
+    'started', 'finished', 'bytes_written', 'status', 'failure', 'stages'
+)
+
+
+class JobHistory:
+    def __init__(self, path, batch_size=32, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.records = Queue()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def record(self, job):
+        row = dict(job)
+        row['stages'] = json.dumps(row.get('stages') or {})
+        self.records.put(tuple(row.get(column) for column in COLUMNS))
+
+    def writer(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(SCHEMA)
+        conn.commit()
+        while True:
+            batch = [self.records.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.records.get(timeout=max(0, deadline - time.monotonic())))
+                except Empty:
+                    break
+            closing = None in batch
+            batch = [row for row in batch if row is not None]
+            if batch:
+                conn.executemany(
+                    f"INSERT OR REPLACE INTO jobs ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                    batch
+                )
+                conn.commit()
+            if closing:
+                conn.close()
+                return
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def history_path(config):
+    path = config['history']['path']
+    return path if os.path.isabs(path) else os.path.join(station_dir(), path)
+
+
+def get_history(config=None):
+    global _history
+    config = config or load_station_config()
+    if not config['history']['enabled']:
+        return None
+    with _history_lock:
+        if _history is None:
+            _history = JobHistory(history_path(config))
+            atexit.register(_history.close)
+        return _history
+
+
+def new_job(job_uuid, slot, disk, image_version, image_digest):
+    disk = disk or {}
+    return {
+        'job_uuid': job_uuid,
+        'station': socket.gethostname(),
+        'slot': slot,
+        'model': disk.get('model'),
+        'serial': disk.get('serial_number'),
+        'image_version': image_version,
+        'image_digest': image_digest,
+        'started': time.time(),
+        'finished': None,
+        'bytes_written': 0,
+        'status': 'running',
+        'failure': None,
+        'stages': {},
+    }
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def query_jobs(conn, since=None):
+    conn.row_factory = sqlite3.Row
+    sql = 'SELECT * FROM jobs WHERE status != ?'
+    params = ['running']
+    if since:
+        sql += ' AND started >= ?'
+        params.append(since)
+    jobs = []
+    for row in conn.execute(sql, params):
+        job = dict(row)
+        job['stages'] = json.loads(job['stages'] or '{}')
+        jobs.append(job)
+    return jobs
+
+
+def group_by(jobs, key):
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job[key] or '-', []).append(job)
+    return groups
+
+
+def write_rate(job):
+    seconds = job['stages'].get('write_img')
+    if job['status'] != 'success' or not seconds or not job['bytes_written']:
+        return None
+    return job['bytes_written'] / seconds / 1024 / 1024
+
+
+def summarize(jobs, key):
+    summary = []
+    for name, group in sorted(group_by(jobs, key).items()):
+        durations = [j['finished'] - j['started'] for j in group if j['status'] == 'success']
+        rates = [r for r in map(write_rate, group) if r]
+        failed = sum(1 for j in group if j['status'] != 'success')
+        summary.append({
+            key: name,
+            'jobs': len(group),
+            'failure_rate': failed / len(group),
+            'p50_seconds': percentile(durations, 0.5),
+            'p95_seconds': percentile(durations, 0.95),
+            'p50_mb_s': percentile(rates, 0.5),
+        })
+    return summary
+
+
+def report(path, since=None):
+    conn = sqlite3.connect(path)
+    try:
+        jobs = query_jobs(conn, since)
+    finally:
+        conn.close()
+    return {
+        'model': summarize(jobs, 'model'),
+        'slot': summarize(jobs, 'slot'),
+        'image_version': summarize(jobs, 'image_version'),
+    }
+
+
+def format_value(value, fmt):
+    return '-' if value is None else format(value, fmt)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report flash job history.')
+    parser.add_argument('--db', default=None)
+    parser.add_argument('--days', type=float, default=None)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    path = args.db or history_path(load_station_config())
+    since = time.time() - args.days * 86400 if args.days else None
+    result = report(path, since)
+    if args.json:
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+        return
+    for key, rows in result.items():
+        print(f'\n{key:<32} {"jobs":>6} {"fail%":>6} {"p50 s":>8} {"p95 s":>8} {"MB/s":>8}')
+        for row in rows:
+            print(
+                f"{str(row[key]):<32} {row['jobs']:>6} {row['failure_rate'] * 100:>6.1f} "
+                f"{format_value(row['p50_seconds'], '.0f'):>8} {format_value(row['p95_seconds'], '.0f'):>8} "
+                f"{format_value(row['p50_mb_s'], '.1f'):>8}"
+            )
+
+
+if __name__ == '__main__':
+    main()
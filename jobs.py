@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from checkpoint import CheckpointStore
+from disks import flashable_disks
+from imagestore import open_station_store
+from qemutool_pe import QemuTool
+from station import load_station_config
+
+ACTIVE = ('queued', 'running')
+
+
+class JobError(Exception):
+    pass
+
+
+class JobLog:
+    def __init__(self, job):
+        self.job = job
+
+    def put(self, message):
+        if message != 'FINISHED':
+            self.job.publish('log', {'message': message})
+
+
+class Job:
+    def __init__(self, device, management_id, device_id, image_version=None, disk=None):
+        self.id = uuid4().hex
+        self.device = device
+        self.management_id = management_id
+        self.device_id = device_id
+        self.image_version = image_version
+        self.disk = disk
+        self.status = 'queued'
+        self.state = None
+        self.percent = 0
+        self.failure = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.tool = None
+        self.cancelled = False
+        self.events = []
+        self.condition = threading.Condition()
+
+    def publish(self, kind, data):
+        with self.condition:
+            self.events.append((kind, dict(data, time=time.time())))
+            self.condition.notify_all()
+
+    def wait(self, index, timeout):
+        with self.condition:
+            if index >= len(self.events) and self.status in ACTIVE:
+                self.condition.wait(timeout)
+            return self.events[index:], self.status not in ACTIVE
+
+    def set_status(self, status, failure=None):
+        self.status = status
+        self.failure = failure
+        if status not in ACTIVE:
+            self.finished = time.time()
+        self.publish('status', {'status': status, 'failure': failure})
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'device': self.device,
+            'management_id': self.management_id,
+            'device_id': self.device_id,
+            'image_version': self.image_version,
+            'status': self.status,
+            'state': self.state,
+            'percent': self.percent,
+            'failure': self.failure,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'job_uuid': self.tool.uuid if self.tool else None,
+            'bytes_written': self.tool.job['bytes_written'] if self.tool else None,
+        }
+
+
+class JobManager:
+    def __init__(self, workers=1, max_queued=8, keep=200, poll_interval=0.5):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='flash')
+        self.max_queued = max_queued
+        self.keep = keep
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, device, management_id, device_id, image_version=None, disk=None):
+        with self.lock:
+            active = [job for job in self.jobs.values() if job.status in ACTIVE]
+            if any(job.device == device for job in active):
+                raise JobError(f'{device} is already queued or being flashed')
+            if sum(1 for job in active if job.status == 'queued') >= self.max_queued:
+                raise JobError('job queue is full')
+            if image_version and not open_station_store().has_version(image_version):
+                raise JobError(f'unknown image version {image_version}')
+            job = Job(device, management_id, device_id, image_version, disk)
+            self.jobs[job.id] = job
+            self.prune()
+        job.publish('status', {'status': job.status, 'failure': None})
+        self.executor.submit(self.run, job)
+        return job
+
+    def prune(self):
+        finished = sorted((job for job in self.jobs.values() if job.status not in ACTIVE), key=lambda job: job.created)
+        for job in finished[:max(0, len(self.jobs) - self.keep)]:
+            del self.jobs[job.id]
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def list(self):
+        return sorted(self.jobs.values(), key=lambda job: job.created)
+
+    def cancel(self, job):
+        with self.lock:
+            job.cancelled = True
+            tool = job.tool
+            if job.status == 'queued' and job.started is None:
+                # frees the queue slot now instead of when a worker gets to it
+                job.set_status('aborted', 'cancelled')
+        if tool:
+            tool.finish_job('aborted', 'cancelled')
+            tool.stop()
+
+    def run(self, job):
+        with self.lock:
+            if job.cancelled:
+                return
+            job.started = time.time()
+        try:
+            tool = QemuTool(
+                job.device, JobLog(job), job.management_id, job.device_id, job.image_version, disk=job.disk
+            )
+        except Exception as e:
+            job.set_status('failed', f'{type(e).__name__}: {e}')
+            return
+        with self.lock:
+            job.tool = tool
+        if job.cancelled:
+            tool.finish_job('aborted', 'cancelled')
+            if tool.transcript:
+                tool.transcript.close()
+            job.set_status('aborted', 'cancelled')
+            return
+        job.set_status('running')
+        thread = threading.Thread(target=job.tool.run, daemon=True)
+        thread.start()
+        while thread.is_alive():
+            thread.join(self.poll_interval)
+            self.poll(job)
+        self.poll(job)
+        result = job.tool.job
+        job.set_status('aborted' if result['status'] == 'running' else result['status'], result['failure'])
+
+    def poll(self, job):
+        tool = job.tool
+        percent = tool.write_progress() if getattr(tool, 'segments', None) else job.percent
+        if tool.current_state != job.state or percent != job.percent:
+            job.state = tool.current_state
+            job.percent = percent
+            job.publish('progress', {'state': job.state, 'percent': percent})
+        if tool.job['status'] != 'running' and tool.running:
+            tool.stop()
+
+    def shutdown(self):
+        for job in self.list():
+            if job.status in ACTIVE:
+                self.cancel(job)
+        self.executor.shutdown(wait=False)
+
+
+def print_event(data):
+    print(json.dumps(data), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a flash job without the GUI, printing JSON lines.')
+    parser.add_argument('--cwd', help='Station directory holding qemutools, img and station.yaml')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('disks', help='List the disks of this station')
+    run = commands.add_parser('run', help='Flash one disk')
+    run.add_argument('device')
+    run.add_argument('management_id')
+    run.add_argument('device_id')
+    run.add_argument('--image-version')
+    args = parser.parse_args()
+    if args.cwd:
+        os.chdir(args.cwd)
+
+    checkpoints = CheckpointStore(load_station_config()['checkpoint']['path'])
+    disks = {disk['device']: disk for disk in flashable_disks(checkpoints)}
+    if args.command == 'disks':
+        print_event(list(disks.values()))
+        return
+    disk = disks.get(args.device)
+    if not disk or not disk['flashable']:
+        print_event({'event': 'status', 'status': 'failed', 'failure': f'{args.device} is not flashable'})
+        sys.exit(2)
+
+    manager = JobManager()
+    try:
+        job = manager.submit(args.device, args.management_id, args.device_id, args.image_version, disk)
+    except JobError as e:
+        print_event({'event': 'status', 'status': 'failed', 'failure': str(e)})
+        sys.exit(2)
+    index = 0
+    done = False
+    while not done:
+        events, done = job.wait(index, timeout=15)
+        for kind, data in events:
+            print_event(dict(data, event=kind))
+        index += len(events)
+    print_event(dict(job.to_dict(), event='result'))
+    sys.exit(0 if job.status == 'success' else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+import os
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+
+def _lock(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+
+
+def _unlock(fd):
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+def try_lock(path):
+    # returns a descriptor that holds the lock until unlock(), or None if someone else holds it
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        _lock(fd)
+    except OSError:
+        os.close(fd)
+        return None
+    return fd
+
+
+def unlock(fd):
+    try:
+        _unlock(fd)
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def file_lock(path, timeout=30.0):
+    # exclusive between processes and between threads, every holder opens its own descriptor
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                _lock(fd)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Timed out waiting for {path}')
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            _unlock(fd)
+    finally:
+        os.close(fd)
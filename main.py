@@ -1,34 +1,28 @@
 import psutil
-import subprocess
 import sys
-import win32com.client
 from PyQt6 import QtWidgets
 from PyQt6.QtGui import QTextCursor
 from PyQt6.QtCore import QThread
 
+from checkpoint import CheckpointStore
+from disks import wmi_disks
 from qemutool import QemuTool
+from station import load_station_config
 
 class DiskImageWriter(QtWidgets.QWidget):
     def __init__(self):
         super().__init__()
         self.qemu_thread = None
         self.qemu_tool = None
+        self.disks = {}
+        self.checkpoints = CheckpointStore(load_station_config()['checkpoint']['path'])
         self.init_ui()
 
     def get_physical_disks(self):
-        physical_disks = []
-        c = win32com.client.Dispatch("WbemScripting.SWbemLocator")
-        connection = c.ConnectServer(".", r"root\cimv2")
-        for disk in connection.ExecQuery("Select * from Win32_DiskDrive"):
-            if self.has_no_partitions(disk.Index):
-                physical_disks.append({
-                    'device': disk.DeviceID,
-                    'index': disk.Index,
-                    'manufacturer': disk.Manufacturer,
-                    'model': disk.Model,
-                    'size': f'{int(int(disk.Size if disk.Size else 0) // (1024 ** 3))}GB',
-                    'serial_number': disk.SerialNumber.strip()
-                })
+        physical_disks = [
+            disk for disk in wmi_disks()
+            if not disk['has_partitions'] or self.checkpoints.exists(disk['serial_number'])
+        ]
         if physical_disks:
             self.log(f"扫描到硬盘: {physical_disks}")
         else:
@@ -82,19 +76,12 @@ class DiskImageWriter(QtWidgets.QWidget):
         self.log_output.append(message)
         self.log_output.textChanged.connect(lambda: self.log_output.moveCursor(QTextCursor.MoveOperation.End))
 
-    def has_no_partitions(self, disk_index):
-        script = f"select disk {disk_index} \n detail disk"
-        process = subprocess.Popen("diskpart", stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, _ = process.communicate(input=script.encode())
-
-        output = stdout.decode('gbk', errors='ignore')
-        return '###' not in output
-
     def on_write_finished(self):
         self.start_button.setEnabled(True)
 
     def refresh_disk_list(self):
         disks = self.get_physical_disks()
+        self.disks = {disk['device']: disk for disk in disks}
         self.disk_table.setRowCount(0)
         for disk in disks:
             row_position = self.disk_table.rowCount()
@@ -158,7 +145,12 @@ class DiskImageWriter(QtWidgets.QWidget):
             self.start_button.setEnabled(True)
             return
         
-        self.qemu_tool = QemuTool(device, management_id, device_id)
+        try:
+            self.qemu_tool = QemuTool(device, management_id, device_id, disk=self.disks.get(device))
+        except ValueError as e:
+            QtWidgets.QMessageBox.critical(self, "错误", f"无法开始刷入: {e}")
+            self.start_button.setEnabled(True)
+            return
         self.qemu_thread = QThread()
         self.qemu_tool.moveToThread(self.qemu_thread)
         self.qemu_tool.output_signal.connect(self.log)
@@ -186,6 +178,10 @@ class DiskImageWriter(QtWidgets.QWidget):
         return True
 
 if __name__ == "__main__":
+    station = load_station_config()
+    if station['api']['enabled']:
+        from webapi import start_api
+        start_api(station)
     app = QtWidgets.QApplication(sys.argv)
     ex = DiskImageWriter()
     ex.show()
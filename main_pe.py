@@ -1,12 +1,12 @@
 import psutil
-import subprocess
 import time
-import re
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, scrolledtext
 from queue import Queue, Empty
 from threading import Thread
+from disks import diskpart_disks
 from qemutool_pe import QemuTool
+from station import load_station_config
 
 class DiskImageWriter(tk.Tk):
     def __init__(self):
@@ -14,68 +14,16 @@ class DiskImageWriter(tk.Tk):
         self.columns = [
             "index", "device", "model", "size", "type", "status"
         ]
-        self.fields = [
-            'disk_id', 'type', 'status', 'path', 'target', 'lun_id',
-            'location_path', 'current_readonly_state', 'readonly', 'boot_disk',
-            'pagefile_disk', 'hibernation_file_disk', 'crashdump_disk', 'clustered_disk'
-        ]
         self.qemu_thread = None
         self.qemu_tool = None
+        self.disks = {}
         self.queue = Queue()
         self.init_ui()
 
-    def run_diskpart_command(self, commands):
-        process = subprocess.Popen(["diskpart"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        stdout, _ = process.communicate(input=commands.encode())
-        return stdout.decode('gbk', errors='ignore')
-
     def get_physical_disks(self):
         physical_disks = []
         try:
-            output = self.run_diskpart_command("list disk\n")
-            
-            disk_info_pattern = re.compile(r"^(\*?)\s+(\w+)\s+(\d+)\s+(\w+)\s+(\d+\s+\w+)\s+(\d+\s+\w+)(?:\s+(\w*))?(?:\s+(\*?))?\r?$", re.MULTILINE)
-            disks = disk_info_pattern.findall(output)
-            
-            for disk in disks:
-                current, drive, index, status, size, free, dyn, gpt = disk
-                disk_info = {
-                    'has_partitions': True,
-                    'current': True if current else False,
-                    'device': f'\\\\.\\PHYSICALDRIVE{index}',
-                    'index': index,
-                    'status': status,
-                    'size': size,
-                    'free': free,
-                    'dyn': dyn,
-                    'gpt': True if gpt else False
-                }
-
-                detail_output = self.run_diskpart_command(f"select disk {index}\ndetail disk\n")
-                if '###' not in detail_output:
-                    disk_info['has_partitions'] = False
-                detail_lines = detail_output.splitlines()
-                start_index = 0
-                count = 0
-                for i, line in enumerate(detail_lines):
-                    if line == 'DISKPART> ':
-                        count += 1
-                    if count == 2:
-                        disk_info['model'] = detail_lines[i + 1].strip()
-                        start_index = i + 2
-                        break
-
-                detail_lines = detail_lines[start_index:]
-                for i, line in enumerate(detail_lines[:len(self.fields)]):
-                    parts = line.split(":", 1)
-                    if len(parts) == 2:
-                        disk_info[self.fields[i]] = parts[1].strip()
-                output_log = f'扫描到{drive}{index}: '
-                for key, value in disk_info.items():
-                    output_log += f'{key}: {value}, '
-                self.log(output_log[:-2])
-
-                physical_disks.append(disk_info)
+            physical_disks = diskpart_disks(self.log)
         except Exception as e:
             self.log(f"获取磁盘信息失败: {e}")
 
@@ -150,6 +98,7 @@ class DiskImageWriter(tk.Tk):
 
     def refresh_disk_list(self):
         disks = self.get_physical_disks()
+        self.disks = {disk['device']: disk for disk in disks}
         for item in self.disk_table.get_children():
             self.disk_table.delete(item)
         for disk in disks:
@@ -200,7 +149,12 @@ class DiskImageWriter(tk.Tk):
             self.start_button.config(state=tk.NORMAL)
             return
         
-        self.qemu_tool = QemuTool(device, self.queue, management_id, device_id)
+        try:
+            self.qemu_tool = QemuTool(device, self.queue, management_id, device_id, disk=self.disks.get(device))
+        except ValueError as e:
+            messagebox.showerror("错误", f"无法开始刷入: {e}")
+            self.start_button.config(state=tk.NORMAL)
+            return
         self.qemu_thread = Thread(target=self.qemu_tool.run)
         self.qemu_thread.start()
 
@@ -224,5 +178,9 @@ class DiskImageWriter(tk.Tk):
         return True
 
 if __name__ == "__main__":
+    station = load_station_config()
+    if station['api']['enabled']:
+        from webapi import start_api
+        start_api(station)
     app = DiskImageWriter()
     app.mainloop()
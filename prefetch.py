@@ -0,0 +1,63 @@
+import os
+import threading
+import time
+
+from imageinfo import RawImage, read_partitions
+
+CHUNK = 4 * 1024 * 1024
+
+
+def warm_read(path, ranges, limit, stop, chunk=CHUNK):
+    done = 0
+    fd = os.open(path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    try:
+        for offset, length in ranges:
+            end = offset + length
+            while offset < end and done < limit and not stop.is_set():
+                step = min(chunk, end - offset, limit - done)
+                if hasattr(os, 'posix_fadvise'):
+                    os.posix_fadvise(fd, offset, step, os.POSIX_FADV_WILLNEED)
+                else:
+                    os.lseek(fd, offset, os.SEEK_SET)
+                    os.read(fd, step)
+                offset += step
+                done += step
+    finally:
+        os.close(fd)
+    return done
+
+
+def probe_target(path):
+    with RawImage(path) as disk:
+        return read_partitions(disk)
+
+
+class Prefetcher(threading.Thread):
+    def __init__(self, steps, background=None, log=None):
+        super().__init__(daemon=True)
+        self.steps = steps
+        self.background = background
+        self.log = log or (lambda message: None)
+        self.ready = threading.Event()
+        self.stopped = threading.Event()
+        self.seconds = None
+
+    def run(self):
+        started = time.monotonic()
+        for step in self.steps:
+            if self.stopped.is_set():
+                break
+            try:
+                step()
+            except Exception as e:
+                self.log(f'预读失败({step.__name__}): {e}')
+        self.seconds = time.monotonic() - started
+        self.ready.set()
+        if self.background and not self.stopped.is_set():
+            try:
+                self.background(self.stopped)
+            except Exception as e:
+                self.log(f'预读失败({self.background.__name__}): {e}')
+
+    def stop(self):
+        self.stopped.set()
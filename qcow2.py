@@ -0,0 +1,131 @@
+import struct
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+QCOW2_MAGIC = b'QFI\xfb'
+OFFSET_MASK = 0x00FFFFFFFFFFFE00
+L2_COMPRESSED = 1 << 62
+L2_ZERO = 1
+INCOMPAT_CORRUPT = 1 << 1
+INCOMPAT_DATA_FILE = 1 << 2
+INCOMPAT_EXTENDED_L2 = 1 << 4
+COMPRESSION_ZLIB = 0
+COMPRESSION_ZSTD = 1
+
+
+class Qcow2Image:
+    def __init__(self, path, l2_cache=64):
+        self.path = path
+        self.file = open(path, 'rb')
+        header = self.file.read(105)
+        (magic, version, backing_offset, _, self.cluster_bits, self.size, crypt_method, l1_size,
+         l1_offset) = struct.unpack_from('>4sIQIIQIIQ', header, 0)
+        if magic != QCOW2_MAGIC or version not in (2, 3):
+            raise ValueError(f'{path} is not a qcow2 image')
+        if backing_offset:
+            raise ValueError(f'{path} has a backing file, flatten it with qemu-img convert first')
+        if crypt_method:
+            raise ValueError(f'{path} is encrypted')
+        self.compression = COMPRESSION_ZLIB
+        if version == 3:
+            incompatible, = struct.unpack_from('>Q', header, 72)
+            header_length, = struct.unpack_from('>I', header, 100)
+            if incompatible & (INCOMPAT_CORRUPT | INCOMPAT_DATA_FILE | INCOMPAT_EXTENDED_L2):
+                raise ValueError(f'{path} uses unsupported qcow2 features ({incompatible:#x})')
+            if header_length > 104:
+                self.compression = header[104]
+        self.cluster_size = 1 << self.cluster_bits
+        self.l2_entries = self.cluster_size // 8
+        self.file.seek(l1_offset)
+        self.l1 = struct.unpack(f'>{l1_size}Q', self.file.read(l1_size * 8))
+        self.l2_cache = OrderedDict()
+        self.l2_cache_size = l2_cache
+
+    def l2_table(self, l1_index):
+        if l1_index >= len(self.l1) or not self.l1[l1_index] & OFFSET_MASK:
+            return None
+        table = self.l2_cache.get(l1_index)
+        if table is None:
+            self.file.seek(self.l1[l1_index] & OFFSET_MASK)
+            table = struct.unpack(f'>{self.l2_entries}Q', self.file.read(self.cluster_size))
+            self.l2_cache[l1_index] = table
+            if len(self.l2_cache) > self.l2_cache_size:
+                self.l2_cache.popitem(last=False)
+        else:
+            self.l2_cache.move_to_end(l1_index)
+        return table
+
+    def l2_entry(self, cluster):
+        table = self.l2_table(cluster // self.l2_entries)
+        return table[cluster % self.l2_entries] if table else 0
+
+    @staticmethod
+    def allocated(entry):
+        return bool(entry & L2_COMPRESSED or (entry & OFFSET_MASK and not entry & L2_ZERO))
+
+    def read_cluster(self, cluster):
+        entry = self.l2_entry(cluster)
+        if not self.allocated(entry):
+            return None
+        if not entry & L2_COMPRESSED:
+            self.file.seek(entry & OFFSET_MASK)
+            return self.file.read(self.cluster_size)
+        shift = 62 - (self.cluster_bits - 8)
+        offset = entry & ((1 << shift) - 1)
+        sectors = ((entry >> shift) & ((1 << (self.cluster_bits - 8)) - 1)) + 1
+        self.file.seek(offset)
+        data = self.file.read(sectors * 512 - (offset & 511))
+        if self.compression == COMPRESSION_ZSTD:
+            if zstandard is None:
+                raise RuntimeError('zstd compressed qcow2 images need the zstandard package')
+            return zstandard.ZstdDecompressor().decompressobj().decompress(data)[:self.cluster_size]
+        return zlib.decompressobj(-12).decompress(data, self.cluster_size)
+
+    def pread(self, offset, length):
+        length = max(0, min(length, self.size - offset))
+        chunks = []
+        while length:
+            cluster, start = divmod(offset, self.cluster_size)
+            step = min(self.cluster_size - start, length)
+            data = self.read_cluster(cluster)
+            chunks.append(data[start:start + step].ljust(step, b'\0') if data else bytes(step))
+            offset += step
+            length -= step
+        return b''.join(chunks)
+
+    def readinto(self, offset, view):
+        data = self.pread(offset, len(view))
+        view[:len(data)] = data
+        return len(data)
+
+    def allocated_ranges(self):
+        ranges = []
+        clusters = (self.size + self.cluster_size - 1) // self.cluster_size
+        for l1_index in range(len(self.l1)):
+            table = self.l2_table(l1_index)
+            if not table:
+                continue
+            base = l1_index * self.l2_entries
+            for index, entry in enumerate(table[:max(0, clusters - base)]):
+                if not self.allocated(entry):
+                    continue
+                offset = (base + index) * self.cluster_size
+                if ranges and ranges[-1][0] + ranges[-1][1] == offset:
+                    ranges[-1][1] += self.cluster_size
+                else:
+                    ranges.append([offset, self.cluster_size])
+        return [(offset, min(length, self.size - offset)) for offset, length in ranges]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -9,24 +9,55 @@ from PyQt6.QtCore import QObject, pyqtSignal
 from queue import Queue
 from uuid import uuid4
 
+from autotune import Calibration, TuneCache, trial_command
+from blockio import drive_spec
+from checkpoint import (CheckpointStore, bytes_before, image_identity, next_segment, segment_command, split_segments,
+                        verify_command)
+from discard import discard_ranges, guest_preflash_command, tail_ranges
+from disks import smart_status
+from health import evaluate, measure, probe_command
+from imageinfo import copy_plan, image_format, open_image
+from imagestore import open_station_store
+from jobhistory import get_history, new_job
+from prefetch import Prefetcher, probe_target, warm_read
+from station import load_station_config
+from transcript import open_transcript
+from vmlaunch import create_overlay, get_vm_profile, optool_command, release_ports, remove_overlay, reserve_ports
+from workflow import FAILED_STATE, load_workflow
+
+STOP_GRACE_SECONDS = 10
+
+
 class QemuTool(QObject):
     finished_signal = pyqtSignal()
     output_signal = pyqtSignal(str)
 
-    def __init__(self, device, management_id, device_id):
+    def __init__(self, device, management_id, device_id, image_version=None, disk=None, prewritten=False):
         super().__init__()
-        self.setup_paths(device, management_id, device_id)
+        self.setup_paths(device, management_id, device_id, image_version)
+        # loaded before the transcript and history writers start, a bad workflow leaves nothing running
+        self.workflow = load_workflow(self.workflow_path, self)
+        self.current_state = self.workflow.start
         self.command_queue = Queue()
         self.core_port = None
         self.core_socket = None
-        self.legacy_boot = False
         self.monitor_port = None
         self.monitor_socket = None
         self.running = True
+        self.prewritten = prewritten
+        self.history = get_history(self.station)
+        self.transcript = open_transcript(self.station, self.uuid, device)
+        self.job = new_job(self.uuid, device, disk, self.image_version, self.image_digest)
+        self.stage_started = time.monotonic()
+        self.checkpoints = None
+        if self.station['checkpoint']['enabled'] and self.job['serial']:
+            self.checkpoints = CheckpointStore(self.station['checkpoint']['path'])
+        self.tune_cache = TuneCache(self.autotune['cache']) if self.autotune['enabled'] else None
         self.output_signal.emit(f'准备刷入固件至 {device}...')
-        self.tasks_queue = Queue()
-        self.setup_tasks()
-        self.current_state = self.tasks_queue.get()
+        self.step_lock = threading.RLock()
+        self.retries = {}
+        self.last_output = self.last_progress = time.monotonic()
+        self.attached = []
 
     def connect_core(self):
         self.output_signal.emit('尝试连接内核...')
@@ -57,182 +88,380 @@ class QemuTool(QObject):
                 time.sleep(1)
 
     def find_available_port(self, start_port=50000, end_port=60000):
-        for port in range(start_port, end_port):
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                try:
-                    sock.bind(('127.0.0.1', port))
-                    if not self.core_port:
-                        self.core_port = port
-                        continue
-                    if not self.monitor_port:
-                        self.monitor_port = port
-                        return
-                except socket.error:
-                    continue
-        raise RuntimeError("No available ports found in the specified range.")
+        self.core_port, self.monitor_port = reserve_ports(2, start_port, end_port)
 
     def prepare_optool_command(self):
         self.find_available_port()
-        return [
-            self.qemu,
-            '-m', '512M',
-            '-drive', f'file={self.optoolImg},format=raw,if=none,id=disk0',
-            '-device', 'virtio-scsi-pci,id=scsi0',
-            '-device', 'scsi-hd,drive=disk0,bus=scsi0.0',
-            '-chardev', f'socket,id=char0,host=127.0.0.1,port={self.core_port},server,nowait',
-            '-serial', 'chardev:char0',
-            '-monitor', f'tcp:127.0.0.1:{self.monitor_port},server,nowait',
-            '-nographic'
-        ]
-
-    def setup_tasks(self):
-        self.tasks_queue.put(self.initial_state)
-        self.tasks_queue.put(self.ready_state)
-        self.tasks_queue.put(self.physicaldrive_check_state)
-        self.tasks_queue.put(self.netflex_check_state)
-        self.tasks_queue.put(self.format_disk_state)
-        self.tasks_queue.put(self.write_img_state)
-        self.tasks_queue.put(self.extend_disk_state)
-        self.tasks_queue.put(self.mount_disk_state)
-        self.tasks_queue.put(self.umount_disk_state)
-        self.tasks_queue.put(self.end_state)
-        self.tasks_queue.put(self.pass_state)
-
-    def initial_state(self, line):
-        if 'Please' in line:
-            time.sleep(1)
-            self.current_state = self.tasks_queue.get()
-            self.output_signal.emit('平台已就绪。')
-            self.command_queue.put('')
-            self.command_queue.put('')
+        if self.vm['name'] == 'disk' and self.vm['overlay'] == 'qcow2':
+            try:
+                self.overlay = create_overlay(self.qemu_img, self.optoolImg, self.uuid)
+            except Exception as e:
+                self.emit(f'创建平台快照失败, 改用临时快照: {e}')
+                self.vm = dict(self.vm, overlay='snapshot')
+        return optool_command(self.qemu, self.vm, self.optoolImg, self.core_port, self.monitor_port, self.overlay)
 
-    def ready_state(self, line):
-        if '#' in line:
-            time.sleep(0.5)
-            self.current_state = self.tasks_queue.get()
-            self.add_drives('physicaldrive')
+    def start_prefetch(self):
+        steps = [self.probe_target]
+        if not self.prewritten:
+            steps.append(self.prepare_image)
+            if self.prefetch['host_preflash'] and sys.platform.startswith('linux'):
+                steps.append(self.host_preflash)
+        self.prefetcher = Prefetcher(steps, None if self.prewritten else self.warm_image, self.emit)
+        self.prefetcher.start()
 
-    def physicaldrive_check_state(self, line):
-        if 'Attached' not in line:
-            return
-        time.sleep(0.5)
-        self.current_state = self.tasks_queue.get()
-        self.command_queue.put('')
-        time.sleep(0.5)
-        self.add_drives('netflex')
+    def probe_target(self):
+        partitions = probe_target(self.device)
+        if partitions:
+            self.emit(f'{self.device}现有{len(partitions)}个分区, 将被覆盖。')
 
-    def netflex_check_state(self, line):
-        if 'Attached' not in line:
-            return
-        time.sleep(0.5)
-        self.current_state = self.tasks_queue.get()
-        self.command_queue.put('')
-        time.sleep(0.5)
-        self.command_queue.put(f'parted /dev/sdb --script mklabel msdos')
-
-    def format_disk_state(self, line):
-        if 'msdos' not in line:
-            return
-        time.sleep(2)
-        self.current_state = self.tasks_queue.get()
-        self.output_signal.emit(f'{self.device}刷入固件...')
-        self.command_queue.put(f'dd if=/dev/sdc of=/dev/sdb bs=4M')
-
-    def write_img_state(self, line):
-        if 'out' in line:
-            time.sleep(0.5)
-            self.current_state = self.tasks_queue.get()
-            self.output_signal.emit(f'修复{self.device}...')
-            self.command_queue.put(f'parted /dev/sdb')
-
-    def extend_disk_state(self, line):
-        if self.legacy_boot:
-            if 'ext2' in line:
-                time.sleep(0.5)
-                self.command_queue.put('resizepart 2 100%')
-                self.legacy_boot = False
-            else:
-                self.output_signal.emit(f'硬盘格式异常，请寻求远程支持。')
-                self.current_state = self.pass_state
-                self.command_queue.put('quit')
-        elif 'I/O' in line:
-            time.sleep(0.5)
-            self.command_queue.put('Retry')
-        elif 'Welcome' in line:
-            time.sleep(0.5)
-            self.command_queue.put('print')
-        elif 'corrupt' in line:
-            time.sleep(0.5)
-            self.command_queue.put('OK')
-        elif 'current' in line:
-            time.sleep(0.5)
-            self.output_signal.emit(f'修复{self.device}分区表...')
-            self.command_queue.put('Fix')
-        elif 'legacy_boot' in line:
-            self.legacy_boot = True
-        elif 'resizepart' in line:
-            time.sleep(0.5)
-            self.command_queue.put('quit')
-        elif 'quit' in line:
-            time.sleep(0.5)
-            self.output_signal.emit(f'检修{self.device}分区...')
-            self.command_queue.put(f'e2fsck -f -p /dev/sdb2')
-        elif 'inconsistency' in line:
-            time.sleep(0.5)
-            self.output_signal.emit(f'硬盘格式异常，请尝试删除分区。')
-            self.current_state = self.pass_state
-        elif 'contiguous' in line:
-            time.sleep(0.5)
-            self.output_signal.emit(f'扩容{self.device}空间...')
-            self.command_queue.put(f'resize2fs /dev/sdb2')
-        elif 'long' in line:
-            time.sleep(1)
-            self.current_state = self.tasks_queue.get()
-            self.output_signal.emit(f'挂载{self.device}...')
-            self.command_queue.put(f'mkdir -p /mnt/disk && mount /dev/sdb2 /mnt/disk')
-
-    def mount_disk_state(self, line):
-        if 'argument' in line:
-            self.current_state = self.pass_state
-            self.output_signal.emit(f'挂载失败，请重启软件重试...')
+    def prepare_image(self):
+        with open_image(self.netflexImg) as image:
+            self.image_size = image.size
+        self.image_identity = image_identity(self.netflexImg, self.image_digest)
+        if self.checkpoints:
+            self.resume_offset = self.checkpoints.load(self.job['serial'], self.image_identity)
+        if self.tune_cache:
+            self.tuned = self.tune_cache.get(self.job['model'], self.job['serial'])
+            if self.tuned:
+                self.use_block_size(self.tuned['block_bytes'], self.tuned['depth'])
+                self.emit(f"{self.device}写入参数: bs={self.block_bytes // 1024}K, 并发{self.write_depth} (缓存)。")
+        self.copy_ranges = (self.block_bytes, self.plan_copy())
+
+    def host_preflash(self):
+        if self.preflash['mode'] == 'off' or self.resume_offset >= self.block_bytes or self.autotune_pending():
             return
-        if 'mkdir' not in line:
+        offset = 0 if self.preflash['scope'] == 'full' else self.image_size
+        self.emit(f'预清理{self.device}...')
+        stats = discard_ranges(
+            self.device, tail_ranges(self.device, offset), self.preflash['mode'], self.preflash['batch_mb'] * 1024 * 1024,
+            self.prefetcher.stopped
+        )
+        if stats['stopped']:
+            self.emit("预清理中止, 由平台继续。")
             return
-        time.sleep(1)
-        self.current_state = self.tasks_queue.get()
-        self.command_queue.put(f'echo -e "{self.yaml}" > /mnt/disk/etc/system.yaml')
+        self.preflash_on_host = True
+        # discarded blocks need not read back as zeros, only a zero-out makes skipping zero blocks safe
+        self.sparse_write = self.sparse_allowed(stats['mode'] == 'zeroout' and not stats['discarded'])
+        self.emit(f"预清理完成, 耗时{stats['seconds']:.1f}秒。")
+
+    def warm_image(self, stop):
+        if self.copy_ranges and self.image_format == 'raw':
+            ranges = self.copy_ranges[1]
+        else:
+            ranges = [(0, os.path.getsize(self.netflexImg))]
+        warm_read(self.netflexImg, ranges, self.prefetch['warm_mb'] * 1024 * 1024, stop)
+
+    def autotune_pending(self):
+        return bool(self.tune_cache) and not self.tuned and self.resume_offset < self.block_bytes
 
-    def umount_disk_state(self, line):
-        if 'argument' in line:
-            self.current_state = self.pass_state
-            self.output_signal.emit(f'挂载失败，请重启软件重试...')
+    def attach_target(self):
+        if self.prefetcher:
+            if not self.prefetch_waiting:
+                self.prefetch_waiting = True
+                threading.Thread(target=self.await_prefetch, args=(self.current_state,), daemon=True).start()
             return
-        if 'heartbeat_retries' not in line:
+        self.add_drives('physicaldrive')
+
+    def await_prefetch(self, state):
+        # runs outside step_lock so serial lines and the watchdog are handled while the host finishes
+        prefetcher = self.prefetcher
+        limit = self.prefetch['wait_seconds']
+        started = time.monotonic()
+        while self.running and not prefetcher.ready.wait(1):
+            # the wait is the state's progress; keeps the timeout and silence checks from recovering it
+            self.last_output = self.last_progress = time.monotonic()
+            waited = self.last_progress - started
+            if waited > 2 * limit:
+                with self.step_lock:
+                    self.fail(f'{self.device}预处理无响应, 请检查硬盘后重试。')
+                return
+            if waited > limit and not prefetcher.stopped.is_set():
+                self.emit(f'预处理超过{limit}秒, 中止剩余步骤...')
+                prefetcher.stop()
+        with self.step_lock:
+            self.step(self.prefetch_finished, prefetcher, state)
+
+    def prefetch_finished(self, prefetcher, state):
+        prefetcher.stop()
+        self.prefetcher = None
+        self.prefetch_waiting = False
+        if prefetcher.seconds is not None:
+            self.emit(f'预读完成, 耗时{prefetcher.seconds:.1f}秒。')
+        if self.running and self.current_state == state:
+            self.attach_target()
+
+    def target_attached(self):
+        if self.precheck['enabled']:
+            return 'precheck'
+        return self.target_ready()
+
+    def target_ready(self):
+        return 'extend_disk' if self.prewritten else 'netflex_check'
+
+    def start_precheck(self):
+        # the guest only sees QEMU's emulated disk, SMART has to come from the host
+        self.smart = None
+        self.smart_reader = threading.Thread(target=self.read_smart, daemon=True)
+        self.smart_reader.start()
+        self.emit(f'检测{self.device}...')
+        self.command_queue.put(probe_command(
+            self.precheck['seq_read_mb'], self.precheck['write_mb'], self.precheck['random_reads'],
+            self.target_dev
+        ))
+
+    def read_smart(self):
+        self.smart = smart_status(self.device)
+
+    def precheck_done(self, *result):
+        self.smart_reader.join(15)
+        metrics = measure(self.precheck, self.smart or 'unavailable', *result)
+        self.emit(
+            f"{self.device}顺序读{metrics['read_mbps']}MB/s, 顺序写{metrics['write_mbps']}MB/s, "
+            f"随机读{metrics['random_ms']}ms, SMART: {metrics['smart']}"
+        )
+        reasons = evaluate(metrics, self.precheck)
+        if reasons:
+            self.fail(f"{self.device}检测不合格: {', '.join(reasons)}")
             return
-        time.sleep(0.5)
-        self.current_state = self.tasks_queue.get()
-        self.output_signal.emit(f'卸载{self.device}...')
-        self.command_queue.put('umount /mnt/disk')
+        return self.target_ready()
+
+    def attach_source(self):
+        self.add_drives('netflex')
+
+    def source_attached(self):
+        if self.image_size is None:
+            self.prepare_image()
+        if self.autotune_pending():
+            return 'autotune'
+        return self.plan_write()
+
+    def plan_write(self):
+        if not self.copy_ranges or self.copy_ranges[0] != self.block_bytes:
+            self.copy_ranges = (self.block_bytes, self.plan_copy())
+        self.segments = split_segments(self.copy_ranges[1], self.segment_bytes)
+        self.plan_bytes = bytes_before(self.segments, self.image_size)
+        if self.resume_offset % self.block_bytes:
+            self.resume_offset = 0
+        if self.resume_offset < self.block_bytes:
+            return self.flash_start_state()
+        self.emit(f'检测到{self.device}未完成的写入, 校验断点...')
+        self.command_queue.put(verify_command(self.resume_offset, self.block_bytes, self.source_dev, self.target_dev))
+        return 'verify_resume'
+
+    def plan_copy(self):
+        if self.station['copy']['mode'] == 'full':
+            return [(0, self.image_size)]
+        try:
+            plan = copy_plan(
+                self.netflexImg, self.block_bytes, self.station['copy']['max_gap_mb'] * 1024 * 1024,
+                self.image_store, self.image_digest
+            )
+        except Exception as e:
+            self.emit(f'分析固件失败, 完整写入: {e}')
+            return [(0, self.image_size)]
+        self.emit(f'固件有效数据{plan["bytes"] // 1024 ** 2}MB / {self.image_size // 1024 ** 2}MB。')
+        return plan['ranges']
+
+    def start_autotune(self):
+        self.calibration = Calibration(
+            [kb * 1024 for kb in self.autotune['block_kb']], self.autotune['depths'],
+            self.autotune['trial_mb'] * 1024 * 1024
+        )
+        self.emit(f'测试{self.device}写入速度...')
+        return self.next_trial()
+
+    def next_trial(self):
+        trial = self.calibration.next()
+        if not trial:
+            return self.finish_autotune()
+        block_bytes, depth = trial
+        self.command_queue.put(trial_command(
+            self.calibration.trial_bytes, block_bytes, depth, self.source_dev, self.target_dev
+        ))
+
+    def trial_done(self, status, started, finished):
+        block_bytes, depth = self.calibration.current
+        if status == '0':
+            self.calibration.record(float(finished) - float(started))
+            self.emit(f'bs={block_bytes // 1024}K 并发{depth}: {self.calibration.results[-1][2]:.1f}MB/s')
+        return self.next_trial()
+
+    def finish_autotune(self):
+        best = self.calibration.best()
+        if not best:
+            self.emit(f'测试{self.device}写入速度失败, 使用默认参数。')
+            return self.plan_write()
+        self.use_block_size(best['block_bytes'], best['depth'])
+        self.tune_cache.put(self.job['model'], self.job['serial'], best)
+        self.emit(f"{self.device}写入参数: bs={self.block_bytes // 1024}K, 并发{self.write_depth}, {best['mb_per_second']}MB/s。")
+        return self.plan_write()
+
+    def use_block_size(self, block_bytes, depth=1):
+        self.block_bytes = block_bytes
+        self.write_depth = depth
+        self.segment_bytes = max(
+            self.block_bytes,
+            self.station['checkpoint']['segment_mb'] * 1024 * 1024 // self.block_bytes * self.block_bytes
+        )
 
-    def end_state(self, line):
-        if 'umount' not in line:
+    def flash_start_state(self):
+        return 'format_disk' if self.preflash['mode'] == 'off' or self.preflash_on_host else 'preflash'
+
+    def resume_verified(self, status):
+        if status != '0':
+            self.emit(f'断点校验失败, 重新写入{self.device}...')
+            self.checkpoints.clear(self.job['serial'])
+            self.resume_offset = 0
+            return self.flash_start_state()
+        self.write_offset = self.resume_offset
+        self.emit(f'从{self.write_progress()}%处继续写入{self.device}...')
+        return 'write_img'
+
+    def start_preflash(self):
+        offset = 0 if self.preflash['scope'] == 'full' else self.image_size
+        self.emit(f'预清理{self.device}...')
+        self.preflash_started = time.monotonic()
+        self.command_queue.put(guest_preflash_command(
+            self.target_dev, self.preflash['mode'], offset, self.preflash['batch_mb'] * 1024 * 1024
+        ))
+
+    def preflash_done(self, status):
+        elapsed = time.monotonic() - self.preflash_started
+        if status == '0':
+            self.sparse_write = self.sparse_allowed(self.preflash['mode'] == 'zeroout')
+            self.emit(f'预清理完成, 耗时{elapsed:.1f}秒。')
+        else:
+            self.emit(f'预清理失败, 耗时{elapsed:.1f}秒, 继续刷入...')
+
+    def sparse_allowed(self, zeroed):
+        return self.preflash['sparse'] and self.preflash['scope'] == 'full' and zeroed
+
+    def write_progress(self):
+        return bytes_before(self.segments, self.write_offset) * 100 // max(self.plan_bytes, 1)
+
+    def write_next_segment(self):
+        segment = next_segment(self.segments, self.write_offset)
+        if not segment:
+            return self.finish_write()
+        offset, length = segment
+        self.segment_start = offset
+        self.segment_end = offset + length
+        self.command_queue.put(segment_command(
+            offset, length, self.block_bytes, self.sparse_write, self.write_depth, self.source_dev, self.target_dev
+        ))
+
+    def segment_done(self, status):
+        if status != '0':
+            self.fail(f'写入{self.device}失败, 请检查硬盘连接后重启软件重试...')
             return
-        self.output_signal.emit('固件刷入成功。')
-        time.sleep(0.5)
-        self.current_state = self.tasks_queue.get()
-        self.output_signal.emit('关闭固件平台...')
-        self.command_queue.put('poweroff')
+        self.write_offset = self.segment_end
+        self.job['bytes_written'] += self.segment_end - self.segment_start
+        if self.checkpoints:
+            self.checkpoints.save(self.job['serial'], self.image_identity, self.write_offset)
+        if next_segment(self.segments, self.write_offset):
+            self.emit(f'已写入{self.write_progress()}%...')
+        return self.write_next_segment()
+
+    def finish_write(self):
+        return 'extend_disk'
+
+    def finish(self):
         self.running = False
+        self.finish_job('success')
+        if self.checkpoints:
+            self.checkpoints.clear(self.job['serial'])
+        self.finished_signal.emit()
+
+    def fail(self, message):
+        self.emit(message)
+        self.current_state = FAILED_STATE
+        self.finish_job('failed', message)
+        self.stop()
         self.finished_signal.emit()
 
-    def pass_state(self, line):
-        pass
+    def watch(self):
+        while self.running:
+            time.sleep(1)
+            with self.step_lock:
+                if self.current_state == FAILED_STATE or not self.running:
+                    continue
+                reason = self.workflow.stalled(self)
+                if reason:
+                    self.step(self.recover, f'在{self.current_state}阶段{reason}')
+
+    def recover(self, reason):
+        policy = self.workflow.states[self.current_state].retry
+        attempt = self.retries.get(self.current_state, 0)
+        if attempt >= len(policy):
+            self.fail(f'{self.device}{reason}, 重试{attempt}次后仍失败, 请检查硬盘后重试。')
+            return
+        recovery = policy[attempt]
+        self.retries[self.current_state] = attempt + 1
+        self.emit(f'{self.device}{reason}, 第{attempt + 1}次重试({recovery})...')
+        self.last_output = time.monotonic()
+        getattr(self, f'recover_{recovery}')()
+
+    def recover_resend(self):
+        if self.workflow.states[self.current_state].enter:
+            self.workflow.enter(self, self.current_state)
+        else:
+            self.last_progress = time.monotonic()
+            self.command_queue.put('')
+
+    def recover_replug(self):
+        self.detach_drives()
+        self.resume_from_progress()
+        self.workflow.enter(self, self.workflow.replug_state)
+
+    def recover_reset(self):
+        self.detach_drives()
+        self.send_monitor_command('system_reset')
+        self.resume_from_progress()
+        self.workflow.enter(self, self.workflow.start)
+
+    def resume_from_progress(self):
+        if self.write_offset >= self.block_bytes:
+            self.resume_offset = self.write_offset
+
+    def stop(self):
+        self.running = False
+        self.command_queue.put('poweroff')
+        # a wedged guest ignores poweroff, and read_core would stay blocked in recv() for good
+        timer = threading.Timer(STOP_GRACE_SECONDS, self.kill_vm)
+        timer.daemon = True
+        timer.start()
+
+    def kill_vm(self):
+        process = self.qemu_process
+        if process and process.poll() is None:
+            process.terminate()
+
+    def finish_job(self, status, failure=None):
+        if self.job['status'] != 'running':
+            return
+        self.job['status'] = status
+        self.job['failure'] = failure
+        self.job['finished'] = time.time()
+        if self.history:
+            self.history.record(self.job)
+
+    def mark_stage(self, state):
+        now = time.monotonic()
+        self.job['stages'][state] = round(self.job['stages'].get(state, 0) + now - self.stage_started, 3)
+        self.stage_started = now
 
     def process_line(self, line):
+        with self.step_lock:
+            self.step(self.workflow.dispatch, self, line)
+
+    def step(self, action, *args):
+        state = self.current_state
         try:
-            self.current_state(line)
+            action(*args)
         except Exception as e:
             self.output_signal.emit(f'Processing Error: {e}')
+        if self.current_state != state:
+            self.mark_stage(state)
 
     def read_core(self):
         buffer = b''
@@ -242,6 +471,8 @@ class QemuTool(QObject):
                 if not data:
                     time.sleep(0.2)
                     continue
+                self.last_output = time.monotonic()
+                self.record('r', data)
                 buffer += data
                 if not b'\n' in buffer:
                     time.sleep(0.2)
@@ -251,7 +482,6 @@ class QemuTool(QObject):
                     line = line.strip()
                     if line:
                         line_str = line.decode('utf-8')
-                        print(line_str)
                         self.process_line(line_str)
                     buffer = lines[-1]
             except Exception as e:
@@ -267,7 +497,7 @@ class QemuTool(QObject):
     def send_command(self):
         while self.running:
             command = self.command_queue.get()
-            print(f'发送命令: {command}')
+            self.record('s', command)
             try:
                 self.core_socket.sendall(f'{command}\n'.encode())
             except Exception as e:
@@ -276,18 +506,49 @@ class QemuTool(QObject):
                 if command == 'poweroff':
                     return
 
-    def setup_paths(self, device, management_id, device_id):
+    def setup_paths(self, device, management_id, device_id, image_version=None):
         if hasattr(sys, '_MEIPASS'):
             sysPath = sys._MEIPASS
         else:
             sysPath = os.path.abspath('.')
         self.device = device
+        self.station = load_station_config()
+        self.io_profile = self.station['io_profile']
+        self.preflash = self.station['preflash']
+        self.sparse_write = False
+        self.autotune = self.station['autotune']
+        self.precheck = self.station['precheck']
+        self.prefetch = self.station['prefetch']
+        self.prefetcher = None
+        self.prefetch_waiting = False
+        self.preflash_on_host = False
+        self.image_size = None
+        self.copy_ranges = None
+        self.tuned = None
+        self.use_block_size(4 * 1024 * 1024)
+        self.resume_offset = 0
+        self.write_offset = 0
         self.qemu = os.path.join(sysPath, 'qemutools', 'qemu-system-x86_64.exe')
-        self.netflexImg = os.path.join(sysPath, 'img', 'netflex.img')
+        self.qemu_img = os.path.join(sysPath, 'qemutools', 'qemu-img.exe')
+        self.image_version = image_version or self.station['image_store']['version']
+        self.image_store = open_station_store(self.station)
+        self.image_digest, self.netflexImg = self.image_store.resolve(self.image_version)
+        if not self.netflexImg:
+            if self.image_version:
+                raise ValueError(f'Image version {self.image_version} is not in the image store')
+            self.netflexImg = os.path.join(sysPath, 'img', 'netflex.img')
+        self.image_format = image_format(self.netflexImg)
         self.optoolImg = os.path.join(sysPath, 'img', 'optool.img')
+        self.vm = get_vm_profile(self.station['vm'], sysPath)
+        self.target_dev = self.vm['target_dev']
+        self.source_dev = self.vm['source_dev']
+        self.overlay = None
+        self.qemu_process = None
+        self.workflow_path = self.station['workflow'] or os.path.join(sysPath, 'workflow.yaml')
+        self.uuid = str(uuid4())
         self.yaml = yaml.dump(
             {
-                'uuid': str(uuid4()),
+                'uuid': self.uuid,
                 'management_id': management_id,
                 'device_id': device_id,
                 'local_port': 56765,
@@ -308,17 +569,23 @@ class QemuTool(QObject):
         ).replace('\n', '\\n').replace('"', '\\"')
 
     def write_img_to_disk(self):
-        process = self.run_qemu(self.prepare_optool_command())
+        process = self.qemu_process = self.run_qemu(self.prepare_optool_command())
+        if self.prefetch['enabled']:
+            self.start_prefetch()
         self.connect_core()
         self.connect_monitor()
         self.output_signal.emit('加载固件平台...')
 
+        self.workflow.enter(self, self.workflow.start)
+
         read_thread = threading.Thread(target=self.read_core)
         read_thread.start()
 
         write_thread = threading.Thread(target=self.send_command)
         write_thread.start()
 
+        threading.Thread(target=self.watch, daemon=True).start()
+
         try:
             read_thread.join()
             write_thread.join()
@@ -329,21 +596,44 @@ class QemuTool(QObject):
                 self.core_socket.close()
             if self.monitor_socket:
                 self.monitor_socket.close()
+            if self.prefetcher:
+                self.prefetcher.stop()
             process.terminate()
             process.wait()
+            if self.overlay:
+                remove_overlay(self.overlay)
+            release_ports(self.core_port, self.monitor_port)
+            self.finish_job('aborted')
+            if self.transcript:
+                self.transcript.close()
+
+    def record(self, kind, data):
+        if self.transcript:
+            self.transcript.record(kind, data)
 
     def add_drives(self, drive_type):
         if drive_type == 'physicaldrive':
             self.output_signal.emit('装载硬盘...')
-            self.send_monitor_command(f'drive_add 0 file={self.device},if=none,id=disk1,format=raw')
-            self.send_monitor_command('device_add scsi-hd,drive=disk1,bus=scsi0.0')
+            self.send_monitor_command(f"drive_add 0 {drive_spec(self.device, 'disk1', 'target', self.io_profile)}")
+            self.send_monitor_command('device_add scsi-hd,drive=disk1,bus=scsi0.0,id=hd1')
+            self.attached.append('hd1')
         elif drive_type == 'netflex':
             self.output_signal.emit('装载固件...')
-            self.send_monitor_command(f'drive_add 0 file={self.netflexImg},if=none,id=disk2,format=raw')
-            self.send_monitor_command('device_add scsi-hd,drive=disk2,bus=scsi0.0')
+            self.send_monitor_command(f"drive_add 0 {drive_spec(self.netflexImg, 'disk2', 'source', self.io_profile, self.image_format)}")
+            self.send_monitor_command('device_add scsi-hd,drive=disk2,bus=scsi0.0,id=hd2')
+            self.attached.append('hd2')
+
+    def detach_drives(self):
+        for device_id in self.attached:
+            self.send_monitor_command(f'device_del {device_id}')
+        self.attached = []
+        time.sleep(2)
+
+    def emit(self, message):
+        self.output_signal.emit(message)
 
     def send_monitor_command(self, command):
-        print(f'发送监视器命令: {command}')
+        self.record('m', command)
         try:
             self.monitor_socket.sendall(f'{command}\n'.encode())
         except Exception as e:
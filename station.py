@@ -0,0 +1,103 @@
+import copy
+import os
+import sys
+import yaml
+
+DEFAULTS = {
+    'io_profile': 'default',
+    'workflow': None,
+    'preflash': {
+        'mode': 'off',
+        'scope': 'tail',
+        'batch_mb': 1024,
+        'sparse': False,
+    },
+    'image_store': {
+        'path': 'images',
+        'budget_gb': None,
+        'version': None,
+    },
+    'copy': {
+        'mode': 'used',
+        'max_gap_mb': 4,
+    },
+    'checkpoint': {
+        'enabled': True,
+        'path': 'checkpoints',
+        'segment_mb': 1024,
+    },
+    'history': {
+        'enabled': True,
+        'path': 'history.db',
+    },
+    'transcript': {
+        'enabled': True,
+        'path': 'transcripts',
+        'max_mb': 16,
+        'keep': 200,
+    },
+    'prefetch': {
+        'enabled': True,
+        'warm_mb': 2048,
+        'wait_seconds': 120,
+        'host_preflash': True,
+    },
+    'precheck': {
+        'enabled': False,
+        'seq_read_mb': 64,
+        'random_reads': 32,
+        'write_mb': 32,
+        'min_read_mbps': 20,
+        'min_write_mbps': 10,
+        'max_random_ms': 50,
+        'require_smart': False,
+    },
+    'autotune': {
+        'enabled': False,
+        'trial_mb': 64,
+        'block_kb': [1024, 4096, 16384],
+        'depths': [1, 2, 4],
+        'cache': 'autotune.json',
+    },
+    'vm': {
+        'profile': 'disk',
+        'memory': None,
+        'overlay': 'snapshot',
+        'kernel': 'img/optool.vmlinuz',
+        'initrd': 'img/optool.initrd',
+        'append': 'console=ttyS0 quiet',
+        'target_dev': None,
+        'source_dev': None,
+    },
+    'api': {
+        'enabled': False,
+        'host': '127.0.0.1',
+        'port': 56780,
+        'workers': 1,
+        'max_queued': 8,
+    },
+}
+
+
+def station_dir():
+    if getattr(sys, 'frozen', False):
+        return os.path.dirname(sys.executable)
+    return os.path.abspath('.')
+
+
+def merge_config(base, override):
+    merged = copy.deepcopy(base)
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_config(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_station_config(path=None):
+    path = path or os.environ.get('IMGWRITER_STATION') or os.path.join(station_dir(), 'station.yaml')
+    if not os.path.exists(path):
+        return copy.deepcopy(DEFAULTS)
+    with open(path, 'r', encoding='utf-8') as f:
+        return merge_config(DEFAULTS, yaml.safe_load(f))
@@ -0,0 +1,46 @@
+import os
+import re
+import shutil
+import subprocess
+
+import pytest
+
+from imageinfo import RawImage, ext_free_ranges
+
+MKE2FS = shutil.which('mke2fs') or shutil.which('mke2fs', path='/sbin:/usr/sbin')
+DUMPE2FS = shutil.which('dumpe2fs') or shutil.which('dumpe2fs', path='/sbin:/usr/sbin')
+
+LAYOUTS = {
+    'ext4': ['-t', 'ext4'],
+    'ext4-no-flex-bg': ['-t', 'ext4', '-O', '^flex_bg'],
+    'ext4-64bit-no-flex-bg': ['-t', 'ext4', '-O', '64bit,^flex_bg'],
+    'ext4-1k': ['-t', 'ext4', '-b', '1024'],
+    'ext3': ['-t', 'ext3'],
+}
+
+
+def dumpe2fs_free_blocks(path):
+    output = subprocess.run([DUMPE2FS, path], check=True, capture_output=True, text=True).stdout
+    free = set()
+    for line in re.findall(r'^\s+Free blocks: (.*)$', output, re.M):
+        for run in filter(None, (part.strip() for part in line.split(','))):
+            first, _, last = run.partition('-')
+            free.update(range(int(first), int(last or first) + 1))
+    block_size = int(re.search(r'^Block size:\s+(\d+)', output, re.M).group(1))
+    return free, block_size
+
+
+@pytest.mark.skipif(not (MKE2FS and DUMPE2FS), reason='e2fsprogs not installed')
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_ext_free_ranges_match_dumpe2fs(tmp_path, layout):
+    path = str(tmp_path / 'fs.img')
+    with open(path, 'wb') as f:
+        f.truncate(512 * 1024 * 1024)
+    subprocess.run([MKE2FS, '-q', '-F', *LAYOUTS[layout], path], check=True)
+    expected, block_size = dumpe2fs_free_blocks(path)
+    with RawImage(path) as image:
+        ranges = ext_free_ranges(image, 0, os.path.getsize(path))
+    free = set()
+    for offset, length in ranges:
+        free.update(range(offset // block_size, (offset + length) // block_size))
+    assert free == expected
@@ -0,0 +1,71 @@
+import os
+from queue import Queue
+
+import workflow
+from transcript import Transcript, serial_lines
+from workflow import load_workflow
+
+WORKFLOW = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflow.yaml')
+
+# guest output as it arrives on the serial socket, lines split across reads
+SERIAL = [
+    b'Please press Enter to activate th',
+    b'is console.\r\n',
+    b'/ # \r\n/ # \r\n',
+    b'[   12.1] sd 0:0:1:0: [sdb] Attached SCSI disk\r\n',
+    b'[   13.4] sd 0:0:2:0: [sdc] Attached SCSI disk\r\n',
+    b'parted /dev/sdb --script mklabel msdos\r\n/ # \r\n',
+    b'SEGMENT_DONE 0\r\n',
+]
+
+HOOKS = {'target_attached': 'netflex_check', 'source_attached': 'format_disk', 'segment_done': 'extend_disk'}
+
+
+class ReplayTool:
+    def __init__(self):
+        self.device = '/dev/sdb'
+        self.target_dev = '/dev/sdb'
+        self.source_dev = '/dev/sdc'
+        self.current_state = None
+        self.last_progress = 0
+        self.retries = {}
+        self.command_queue = Queue()
+        self.messages = []
+        self.calls = []
+
+    def emit(self, message):
+        self.messages.append(message)
+
+    def __getattr__(self, name):
+        def hook(*args):
+            self.calls.append(name)
+            return HOOKS.get(name)
+        return hook
+
+
+def test_replayed_serial_lines_drive_the_workflow(tmp_path, monkeypatch):
+    monkeypatch.setattr(workflow.time, 'sleep', lambda seconds: None)
+    transcript = Transcript(str(tmp_path), 'job', {'job_uuid': 'job', 'device': '/dev/sdb'})
+    transcript.record('s', '')
+    for data in SERIAL:
+        transcript.record('r', data)
+    transcript.close()
+
+    flow = load_workflow(WORKFLOW)
+    tool = ReplayTool()
+    flow.enter(tool, flow.start)
+    states = []
+    for _, line in serial_lines(os.path.join(str(tmp_path), 'job')):
+        flow.dispatch(tool, line)
+        states.append(tool.current_state)
+
+    assert states == [
+        'ready', 'physicaldrive_check', 'physicaldrive_check', 'netflex_check', 'format_disk', 'write_img',
+        'write_img', 'extend_disk',
+    ]
+    assert tool.calls == [
+        'attach_target', 'target_attached', 'attach_source', 'source_attached', 'write_next_segment', 'segment_done',
+    ]
+    sent = list(tool.command_queue.queue)
+    assert 'parted /dev/sdb --script mklabel msdos' in sent
+    assert sent[-1] == 'parted /dev/sdb'
@@ -0,0 +1,190 @@
+import argparse
+import glob
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+from queue import Empty, Queue
+
+from station import load_station_config, station_dir
+
+KINDS = {'r': 'serial', 's': 'send', 'm': 'monitor'}
+
+
+class Transcript:
+    def __init__(self, directory, name, header, max_bytes=16 * 1024 * 1024, keep=200, flush_interval=1.0):
+        self.directory = directory
+        self.name = name
+        self.header = header
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.flush_interval = flush_interval
+        self.started = time.monotonic()
+        self.records = Queue()
+        self.thread = threading.Thread(target=self.writer, daemon=True)
+        self.thread.start()
+
+    def record(self, kind, data):
+        self.records.put((time.monotonic(), kind, data))
+
+    def open_part(self, part):
+        path = os.path.join(self.directory, f'{self.name}.{part}.jsonl.gz')
+        f = gzip.open(path, 'wt', encoding='utf-8', compresslevel=6)
+        f.write(json.dumps(dict(self.header, part=part, wall_clock=time.time())) + '\n')
+        return f
+
+    def writer(self):
+        os.makedirs(self.directory, exist_ok=True)
+        prune(self.directory, self.keep)
+        part = 0
+        f = self.open_part(part)
+        written = 0
+        dirty = False
+        try:
+            while True:
+                try:
+                    record = self.records.get(timeout=self.flush_interval)
+                except Empty:
+                    # sync flush so a crashed job still leaves a readable transcript
+                    if dirty:
+                        f.flush()
+                        dirty = False
+                    continue
+                if record is None:
+                    return
+                timestamp, kind, data = record
+                if isinstance(data, bytes):
+                    data = data.decode('latin-1')
+                line = json.dumps([round(timestamp - self.started, 3), kind, data], ensure_ascii=False) + '\n'
+                if written + len(line) > self.max_bytes and written:
+                    f.close()
+                    part += 1
+                    f = self.open_part(part)
+                    written = 0
+                f.write(line)
+                written += len(line)
+                dirty = True
+        finally:
+            f.close()
+
+    def close(self):
+        self.records.put(None)
+        self.thread.join()
+
+
+def prune(directory, keep):
+    parts = sorted(glob.glob(os.path.join(directory, '*.jsonl.gz')), key=os.path.getmtime)
+    for path in parts[:max(0, len(parts) - keep)]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def transcript_dir(config):
+    path = config['transcript']['path']
+    return path if os.path.isabs(path) else os.path.join(station_dir(), path)
+
+
+def open_transcript(config, job_uuid, device):
+    settings = config['transcript']
+    if not settings['enabled']:
+        return None
+    return Transcript(
+        transcript_dir(config), job_uuid, {'job_uuid': job_uuid, 'device': device},
+        settings['max_mb'] * 1024 * 1024, settings['keep']
+    )
+
+
+def transcript_parts(path):
+    if path.endswith('.jsonl.gz'):
+        path = path.rsplit('.', 3)[0]
+    parts = glob.glob(f'{glob.escape(path)}.*.jsonl.gz')
+    return sorted(parts, key=lambda part: int(part.rsplit('.', 3)[1]))
+
+
+def read_transcript(path):
+    for part in transcript_parts(path):
+        with gzip.open(part, 'rt', encoding='utf-8') as f:
+            try:
+                next(f, None)
+                for line in f:
+                    timestamp, kind, data = json.loads(line)
+                    yield timestamp, kind, data.encode('latin-1') if kind == 'r' else data
+            except (EOFError, ValueError):
+                # the tail of a transcript whose job was killed mid-write
+                return
+
+
+def serial_lines(path):
+    buffer = b''
+    for timestamp, kind, data in read_transcript(path):
+        if kind != 'r':
+            continue
+        buffer += data
+        lines = buffer.split(b'\n')
+        buffer = lines[-1]
+        for line in lines[:-1]:
+            line = line.strip()
+            if line:
+                yield timestamp, line.decode('utf-8', 'replace')
+
+
+def show(path, min_gap=0.0):
+    previous = 0.0
+    buffer = b''
+    for timestamp, kind, data in read_transcript(path):
+        if kind == 'r':
+            buffer += data
+            lines = buffer.split(b'\n')
+            buffer = lines[-1]
+            texts = [line.strip().decode('utf-8', 'replace') for line in lines[:-1] if line.strip()]
+        else:
+            texts = [data]
+        for text in texts:
+            gap = timestamp - previous
+            if gap >= min_gap:
+                print(f'{timestamp:10.3f} +{gap:8.3f} {KINDS[kind]:<7} {text}')
+            previous = timestamp
+
+
+def replay(path, speed=1.0, out=None):
+    out = out or sys.stdout.buffer
+    started = time.monotonic()
+    for timestamp, kind, data in read_transcript(path):
+        if kind != 'r':
+            continue
+        if speed:
+            delay = timestamp / speed - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
+        out.write(data)
+        out.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect or replay serial transcripts of flash jobs.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    show_parser = sub.add_parser('show', help='Print the timeline of a job')
+    show_parser.add_argument('transcript', help='Job uuid, or any part file of it')
+    show_parser.add_argument('--min-gap', type=float, default=0.0, help='Only print events after a gap this long')
+    replay_parser = sub.add_parser('replay', help='Write the recorded serial output at its original pace')
+    replay_parser.add_argument('transcript')
+    replay_parser.add_argument('--speed', type=float, default=1.0, help='Playback speed, 0 for no delays')
+    args = parser.parse_args()
+
+    path = args.transcript
+    if not os.path.dirname(path):
+        path = os.path.join(transcript_dir(load_station_config()), path)
+    if not transcript_parts(path):
+        parser.error(f'no transcript found for {args.transcript}')
+    if args.command == 'show':
+        show(path, args.min_gap)
+    else:
+        replay(path, args.speed)
+
+
+if __name__ == '__main__':
+    main()
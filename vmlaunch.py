@@ -0,0 +1,138 @@
+import os
+import socket
+import subprocess
+import tempfile
+import threading
+
+from locking import try_lock, unlock
+
+VM_PROFILES = {
+    # boots optool.img through the BIOS; the platform disk is sda in the guest
+    'disk': {
+        'memory': '512M',
+        'machine': None,
+        'controller': 'virtio-scsi-pci',
+        'target_dev': '/dev/sdb',
+        'source_dev': '/dev/sdc',
+    },
+    # boots the optool kernel and initramfs directly on a stripped q35 machine
+    'kernel': {
+        'memory': '192M',
+        'machine': 'q35',
+        'controller': 'virtio-scsi-pci',
+        'target_dev': '/dev/sda',
+        'source_dev': '/dev/sdb',
+    },
+    # minimal virtio-mmio machine, no PCI bus, no firmware option ROMs
+    'microvm': {
+        'memory': '192M',
+        'machine': 'microvm,x-option-roms=off,rtc=on',
+        'controller': 'virtio-scsi-device',
+        'target_dev': '/dev/sda',
+        'source_dev': '/dev/sdb',
+    },
+}
+
+OVERLAY_MODES = ('off', 'snapshot', 'qcow2')
+
+# ports handed to a VM that may not have bound them yet, with the lock file held for each; the lock
+# files keep parallel jobs.py processes on one station from picking the same ports
+_reserved_ports = {}
+_ports_lock = threading.Lock()
+
+
+def get_vm_profile(config, base_dir):
+    if config['profile'] not in VM_PROFILES:
+        raise ValueError(f"Unknown VM profile: {config['profile']}")
+    if config['overlay'] not in OVERLAY_MODES:
+        raise ValueError(f"Unknown optool overlay mode: {config['overlay']}")
+    profile = dict(VM_PROFILES[config['profile']], name=config['profile'])
+    for key, value in config.items():
+        if key != 'profile' and value is not None:
+            profile[key] = value
+    if profile['name'] != 'disk':
+        for key in ('kernel', 'initrd'):
+            if not os.path.isabs(profile[key]):
+                profile[key] = os.path.join(base_dir, profile[key])
+            if not os.path.exists(profile[key]):
+                raise ValueError(f"VM profile {profile['name']} needs {profile[key]}")
+    return profile
+
+
+def reserve_ports(count, start_port=50000, end_port=60000):
+    directory = os.path.join(tempfile.gettempdir(), 'imgwriter-ports')
+    os.makedirs(directory, exist_ok=True)
+    reserved = {}
+    with _ports_lock:
+        for port in range(start_port, end_port):
+            if port in _reserved_ports:
+                continue
+            fd = try_lock(os.path.join(directory, f'{port}.lock'))
+            if fd is None:
+                continue
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                try:
+                    sock.bind(('127.0.0.1', port))
+                except socket.error:
+                    unlock(fd)
+                    continue
+            reserved[port] = fd
+            if len(reserved) == count:
+                _reserved_ports.update(reserved)
+                return list(reserved)
+        for fd in reserved.values():
+            unlock(fd)
+    raise RuntimeError("No available ports found in the specified range.")
+
+
+def release_ports(*ports):
+    with _ports_lock:
+        for port in ports:
+            fd = _reserved_ports.pop(port, None)
+            if fd is not None:
+                unlock(fd)
+
+
+def create_overlay(qemu_img, base, name):
+    directory = os.path.join(tempfile.gettempdir(), 'imgwriter-overlays')
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'{name}.qcow2')
+    subprocess.run(
+        [qemu_img, 'create', '-q', '-f', 'qcow2', '-F', 'raw', '-b', base, path],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    return path
+
+
+def remove_overlay(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def optool_command(qemu, profile, optool_img, core_port, monitor_port, overlay=None):
+    command = [qemu]
+    if profile['machine']:
+        command += ['-M', profile['machine'], '-nodefaults', '-no-user-config']
+    command += ['-m', profile['memory'], '-device', f"{profile['controller']},id=scsi0"]
+    if profile['name'] == 'disk':
+        if overlay:
+            disk = f'file={overlay},format=qcow2,if=none,id=disk0'
+        else:
+            disk = f'file={optool_img},format=raw,if=none,id=disk0'
+            # writes go to a temporary overlay QEMU drops on exit, the shared base stays untouched
+            if profile['overlay'] == 'snapshot':
+                disk += ',snapshot=on'
+        command += [
+            '-drive', disk,
+            '-device', 'scsi-hd,drive=disk0,bus=scsi0.0',
+        ]
+    else:
+        command += ['-kernel', profile['kernel'], '-initrd', profile['initrd'], '-append', profile['append']]
+    return command + [
+        '-chardev', f'socket,id=char0,host=127.0.0.1,port={core_port},server,nowait',
+        '-serial', 'chardev:char0',
+        '-monitor', f'tcp:127.0.0.1:{monitor_port},server,nowait',
+        '-nographic'
+    ]
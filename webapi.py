@@ -0,0 +1,137 @@
+import argparse
+import json
+import threading
+
+from flask import Flask, Response, jsonify, request
+
+from checkpoint import CheckpointStore
+from disks import flashable_disks
+from imagestore import open_station_store
+from jobs import JobError, JobManager
+from station import load_station_config
+
+
+def create_app(config=None, manager=None):
+    config = config or load_station_config()
+    manager = manager or JobManager(config['api']['workers'], config['api']['max_queued'])
+    checkpoints = CheckpointStore(config['checkpoint']['path'])
+    app = Flask(__name__)
+    app.config['JOB_MANAGER'] = manager
+    disks = {}
+
+    def refresh_disks():
+        disks.clear()
+        for disk in flashable_disks(checkpoints):
+            disks[disk['device']] = disk
+        return list(disks.values())
+
+    def error(message, status):
+        return jsonify({'error': message}), status
+
+    @app.get('/disks')
+    def get_disks():
+        return jsonify(refresh_disks())
+
+    @app.get('/images')
+    def get_images():
+        return jsonify(open_station_store(config).list())
+
+    @app.get('/jobs')
+    def get_jobs():
+        return jsonify([job.to_dict() for job in manager.list()])
+
+    @app.post('/jobs')
+    def post_job():
+        body = request.get_json(silent=True) or {}
+        missing = [key for key in ('device', 'management_id', 'device_id') if not body.get(key)]
+        if missing:
+            return error(f"missing {', '.join(missing)}", 400)
+        disk = disks.get(body['device'])
+        if disk is None:
+            refresh_disks()
+            disk = disks.get(body['device'])
+        if disk is None:
+            return error(f"unknown device {body['device']}", 404)
+        if not disk['flashable']:
+            return error(f"{body['device']} has partitions or is the system disk", 409)
+        if body.get('image_version') and not open_station_store(config).has_version(body['image_version']):
+            return error(f"unknown image version {body['image_version']}", 404)
+        try:
+            job = manager.submit(
+                body['device'], body['management_id'], body['device_id'], body.get('image_version'), disk
+            )
+        except JobError as e:
+            return error(str(e), 409)
+        return jsonify(job.to_dict()), 201
+
+    @app.get('/jobs/<job_id>')
+    def get_job(job_id):
+        job = manager.get(job_id)
+        if not job:
+            return error('unknown job', 404)
+        return jsonify(job.to_dict())
+
+    @app.delete('/jobs/<job_id>')
+    def delete_job(job_id):
+        job = manager.get(job_id)
+        if not job:
+            return error('unknown job', 404)
+        manager.cancel(job)
+        return jsonify(job.to_dict())
+
+    @app.get('/jobs/<job_id>/events')
+    def job_events(job_id):
+        job = manager.get(job_id)
+        if not job:
+            return error('unknown job', 404)
+        try:
+            index = max(0, int(request.headers.get('Last-Event-ID', -1)) + 1)
+        except ValueError:
+            index = 0
+
+        def stream():
+            nonlocal index
+            while True:
+                events, done = job.wait(index, timeout=15)
+                if not events and not done:
+                    yield ': keepalive\n\n'
+                for kind, data in events:
+                    yield f'id: {index}\nevent: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n'
+                    index += 1
+                if done and not events:
+                    return
+
+        return Response(stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    return app
+
+
+def start_api(config):
+    app = create_app(config)
+    thread = threading.Thread(
+        target=app.run,
+        kwargs={'host': config['api']['host'], 'port': config['api']['port'], 'threaded': True},
+        daemon=True
+    )
+    thread.start()
+    return app
+
+
+def main():
+    config = load_station_config()
+    parser = argparse.ArgumentParser(description='Serve the flash job API on localhost.')
+    parser.add_argument('--host', default=config['api']['host'])
+    parser.add_argument('--port', type=int, default=config['api']['port'])
+    parser.add_argument('--workers', type=int, default=config['api']['workers'])
+    args = parser.parse_args()
+
+    manager = JobManager(args.workers, config['api']['max_queued'])
+    app = create_app(config, manager)
+    try:
+        app.run(host=args.host, port=args.port, threaded=True)
+    finally:
+        manager.shutdown()
+
+
+if __name__ == '__main__':
+    main()
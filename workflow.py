@@ -0,0 +1,164 @@
+import re
+import time
+import yaml
+
+ACTIONS = ('sleep', 'emit', 'send', 'call', 'goto', 'resume', 'retry', 'fail')
+RECOVERIES = ('resend', 'replug', 'reset')
+FAILED_STATE = 'pass'
+
+
+class WorkflowError(ValueError):
+    pass
+
+
+class Rule:
+    def __init__(self, pattern, actions, group_index):
+        self.pattern = pattern
+        self.actions = actions
+        self.group_index = group_index
+        self.group_count = re.compile(pattern).groups
+
+
+class State:
+    def __init__(self, name, spec, watchdog=None):
+        self.name = name
+        watchdog = dict(watchdog or {}, **(spec.get('watchdog') or {}))
+        self.timeout = watchdog.get('timeout')
+        self.silence = watchdog.get('silence')
+        self.retry = watchdog.get('retry') or []
+        for recovery in self.retry:
+            if recovery not in RECOVERIES:
+                raise WorkflowError(f'{name}: unknown recovery {recovery}')
+        self.enter = parse_actions(spec.get('enter'), name)
+        self.otherwise = parse_actions(spec.get('otherwise'), name)
+        self.rules = []
+        parts = []
+        group_index = 1
+        for i, rule in enumerate(spec.get('rules') or []):
+            if 'match' not in rule:
+                raise WorkflowError(f'{name}: rule {i} has no match pattern')
+            compiled = Rule(rule['match'], parse_actions(rule.get('do'), name), group_index)
+            self.rules.append(compiled)
+            parts.append(f'.*?(?P<r{i}>{rule["match"]})')
+            group_index += compiled.group_count + 1
+        self.matcher = re.compile('|'.join(parts)) if parts else None
+        if not parts:
+            self.timeout = self.silence = None
+
+    def stalled(self, tool, now):
+        if self.timeout and now - tool.last_progress > self.timeout:
+            return f'{self.timeout}秒无进展'
+        if self.silence and now - tool.last_output > self.silence:
+            return f'{self.silence}秒无输出'
+        return None
+
+    def classify(self, line):
+        if self.matcher:
+            m = self.matcher.match(line)
+            if m:
+                rule = self.rules[int(m.lastgroup[1:])]
+                start = rule.group_index
+                return rule.actions, m.groups()[start:start + rule.group_count]
+        if self.otherwise:
+            return self.otherwise, ()
+        return None, ()
+
+
+def parse_actions(actions, state_name):
+    parsed = []
+    for action in actions or []:
+        if not isinstance(action, dict) or len(action) != 1:
+            raise WorkflowError(f'{state_name}: each action must be a single-key mapping, got {action!r}')
+        kind, value = next(iter(action.items()))
+        if kind not in ACTIONS:
+            raise WorkflowError(f'{state_name}: unknown action {kind}')
+        parsed.append((kind, value))
+    return parsed
+
+
+class Workflow:
+    def __init__(self, spec):
+        self.name = spec.get('name', 'workflow')
+        self.start = spec['start']
+        watchdog = dict(spec.get('watchdog') or {})
+        self.replug_state = watchdog.pop('replug_state', self.start)
+        self.states = {name: State(name, state, watchdog) for name, state in spec['states'].items()}
+        self.states.setdefault(FAILED_STATE, State(FAILED_STATE, {}))
+        self.validate()
+
+    def validate(self):
+        for name in (self.start, self.replug_state):
+            if name not in self.states:
+                raise WorkflowError(f'Unknown state: {name}')
+        for state in self.states.values():
+            actions = list(state.enter) + list(state.otherwise)
+            for rule in state.rules:
+                actions += rule.actions
+            for kind, value in actions:
+                if kind in ('goto', 'resume') and value not in self.states:
+                    raise WorkflowError(f'{state.name}: unknown state {value}')
+
+    def check_hooks(self, tool):
+        for state in self.states.values():
+            actions = list(state.enter) + list(state.otherwise)
+            for rule in state.rules:
+                actions += rule.actions
+            for kind, value in actions:
+                if kind == 'call' and not callable(getattr(tool, value, None)):
+                    raise WorkflowError(f'{state.name}: unknown hook {value}')
+
+    def enter(self, tool, name):
+        tool.current_state = name
+        tool.last_progress = time.monotonic()
+        self.run(tool, self.states[name].enter)
+
+    def dispatch(self, tool, line):
+        actions, groups = self.states[tool.current_state].classify(line)
+        if actions:
+            tool.last_progress = time.monotonic()
+            if all(kind != 'retry' for kind, _ in actions):
+                tool.retries.pop(tool.current_state, None)
+            self.run(tool, actions, groups)
+
+    def stalled(self, tool):
+        return self.states[tool.current_state].stalled(tool, time.monotonic())
+
+    def run(self, tool, actions, groups=()):
+        for kind, value in actions:
+            if kind == 'sleep':
+                time.sleep(value)
+            elif kind == 'emit':
+                tool.emit(value.format_map(tool.__dict__))
+            elif kind == 'send':
+                tool.command_queue.put(value.format_map(tool.__dict__))
+            elif kind == 'call':
+                target = getattr(tool, value)(*groups)
+                if target:
+                    if target not in self.states:
+                        raise WorkflowError(f'{value} returned unknown state {target}')
+                    self.enter(tool, target)
+                    return
+            elif kind == 'goto':
+                self.enter(tool, value)
+                return
+            elif kind == 'resume':
+                tool.current_state = value
+                return
+            elif kind == 'retry':
+                tool.recover(value.format_map(tool.__dict__))
+                return
+            elif kind == 'fail':
+                tool.fail(value.format_map(tool.__dict__))
+                return
+
+
+def load_workflow(path, tool=None):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            spec = yaml.safe_load(f)
+    except (OSError, yaml.YAMLError) as e:
+        raise WorkflowError(f'Cannot load workflow {path}: {e}')
+    workflow = Workflow(spec)
+    if tool is not None:
+        workflow.check_hooks(tool)
+    return workflow